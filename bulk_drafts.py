@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+
+from draft_engine import DoneEvent, ToolResultEvent
+from engine_factory import build_engine
+
+# Drafts replies for a backlog of inquiries with the same retrieval and letter prompt as the
+# tools page. Input is JSONL or CSV with one inquiry per row; every result is appended to a
+# JSONL output file as soon as it is done, and a restart skips ids already in that file.
+# Drafts whose searches failed are kept with their retrieval_errors and drafted again.
+#
+#   python bulk_drafts.py inquiries.csv drafts.jsonl --concurrency 8 --retrieval-first
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TEXT_FIELD = "inquiry"
+DEFAULT_ID_FIELD = "id"
+PREFETCH_BATCH = 64
+PROGRESS_EVERY = 10
+
+
+# Function to read inquiries from a JSONL or CSV file as (id, text) pairs; rows without an id get their row number
+def read_inquiries(path, text_field=DEFAULT_TEXT_FIELD, id_field=DEFAULT_ID_FIELD):
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+    inquiries = []
+    for number, row in enumerate(rows, start=1):
+        text = (row.get(text_field) or "").strip()
+        item_id = row.get(id_field)
+        if text:
+            inquiries.append((str(number if item_id in (None, "") else item_id), text))
+    return inquiries
+
+
+# Function to collect the ids that already have a successful result (no error, complete retrieval) in the output file
+def completed_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run is drafted again
+                continue
+            if not record.get("error") and not record.get("retrieval_errors"):
+                done.add(record["id"])
+    return done
+
+
+# Function to draft one inquiry and return its output record
+async def draft_one(engine, item_id, text):
+    started = time.monotonic()
+    record = {"id": item_id, "inquiry": text}
+    retrieval_errors = {}
+    try:
+        async for event in engine.run([{"role": "user", "content": text}]):
+            if isinstance(event, ToolResultEvent):
+                retrieval_errors.update(event.errors)
+            elif isinstance(event, DoneEvent):
+                record.update(response=event.response, letter="".join(event.letters), usage=event.usage)
+    except Exception as e:
+        record["error"] = str(e)
+    if retrieval_errors:
+        # The draft may lack sources, so it does not count as done
+        record["retrieval_errors"] = retrieval_errors
+    record["seconds"] = round(time.monotonic() - started, 3)
+    return record
+
+
+# Function to embed every inquiry up front in large batches, so the per-item searches hit the embedding cache
+async def prefetch_embeddings(engine, texts):
+    backend = engine.retriever.embedding_backend
+    for start in range(0, len(texts), PREFETCH_BATCH):
+        try:
+            await asyncio.to_thread(backend.embed_many, texts[start:start + PREFETCH_BATCH])
+        except Exception as e:
+            print(f"Could not prefetch embeddings: {e}")
+            return
+
+
+async def run_batch(engine, inquiries, output_path, concurrency):
+    pending = asyncio.Queue()
+    for item in inquiries:
+        pending.put_nowait(item)
+    totals = {"done": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    started = time.monotonic()
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        async def worker():
+            while not pending.empty():
+                item_id, text = pending.get_nowait()
+                record = await draft_one(engine, item_id, text)
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                if record.get("usage"):
+                    totals["prompt_tokens"] += record["usage"]["prompt_tokens"]
+                    totals["completion_tokens"] += record["usage"]["completion_tokens"]
+                if record.get("error") or record.get("retrieval_errors"):
+                    totals["failed"] += 1
+                    print(f"{item_id}: failed: {record.get('error') or record['retrieval_errors']}")
+                else:
+                    totals["done"] += 1
+                finished = totals["done"] + totals["failed"]
+                if finished % PROGRESS_EVERY == 0 or finished == len(inquiries):
+                    minutes = (time.monotonic() - started) / 60
+                    print(f"{finished}/{len(inquiries)} drafts, {totals['done'] / minutes:.1f} drafts/min, {totals['prompt_tokens'] + totals['completion_tokens']} tokens")
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(inquiries)))))
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Drafted {totals['done']} ({totals['failed']} failed) in {elapsed:.1f}s: "
+        f"{totals['done'] / (elapsed / 60):.1f} drafts/min, "
+        f"{totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion tokens"
+    )
+    return totals
+
+
+async def main_async(args):
+    engine = build_engine(**({"retrieval_first": True} if args.retrieval_first else {}))
+    inquiries = read_inquiries(args.input, args.text_field, args.id_field)
+    done = completed_ids(args.output)
+    todo = [(item_id, text) for item_id, text in inquiries if item_id not in done]
+    print(f"{len(inquiries)} inquiries, {len(inquiries) - len(todo)} already drafted, {len(todo)} to go")
+    if not todo:
+        return
+    # With retrieval first or speculative retrieval the searches use the inquiry text itself
+    if engine.config.retrieval_first or engine.config.speculative_retrieval:
+        await prefetch_embeddings(engine, [text for _, text in todo])
+    await run_batch(engine, todo, args.output, args.concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Draft replies for a file of inquiries")
+    parser.add_argument("input", help="JSONL or CSV file with one inquiry per row")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--text-field", default=DEFAULT_TEXT_FIELD)
+    parser.add_argument("--id-field", default=DEFAULT_ID_FIELD)
+    parser.add_argument("--retrieval-first", action="store_true", help="Search for each inquiry before the model is called")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import streamlit as st
+
+from letter_stream import parse_segments
+
+DEFAULT_HISTORY_WINDOW = 20
+
+
+# Function to build a chat message with its text/letter segments parsed once, up front
+def make_message(role, content, **extra):
+    return {"role": role, "content": content, "segments": parse_segments(content), **extra}
+
+
+# Function to render one message by walking its pre-parsed segments
+def render_message(message):
+    if "segments" not in message:
+        message["segments"] = parse_segments(message["content"])
+    with st.chat_message(message["role"]):
+        for segment in message["segments"]:
+            if segment["type"] == "letter":
+                with st.expander("Brev"):
+                    st.markdown(segment["content"])
+            else:
+                st.markdown(segment["content"])
+
+
+# Function to render the chat history, fully materializing only the last `window` messages
+def render_history(messages, window_key="history_window", window=DEFAULT_HISTORY_WINDOW):
+    if window_key not in st.session_state:
+        st.session_state[window_key] = window
+    visible = [message for message in messages if message["role"] in ("user", "assistant") and message.get("content")]
+    hidden = len(visible) - st.session_state[window_key]
+    if hidden > 0:
+        if st.button(f"Visa tidigare meddelanden ({hidden} dolda)", key=f"{window_key}_more"):
+            st.session_state[window_key] += window
+            st.rerun()
+        visible = visible[hidden:]
+    for message in visible:
+        render_message(message)
@@ -1,6 +1,12 @@
+import json
+import uuid
+
 import streamlit as st
-from openai import OpenAI
-import re
+from chat_render import make_message, render_history
+from clients import get_openai_client
+from letter_stream import CHAT, LETTER, LETTER_START, LetterStreamParser
+from rate_limiter import CHAT as CHAT_ENDPOINT, DEFAULT_COMPLETION_RESERVE, call_with_limits, estimate_tokens, get_rate_limiter
+from render_throttle import DEFAULT_FLUSH_CHARS, DEFAULT_MAX_HZ, RenderScheduler
 
 SYSTEM_MESSAGE = {"role": "system", 
                   "content": "Du är en hjälpsam assistent som ibland svarar med ett separat brev markerat inom tags <letter>[letter content in markdown]</letter>"}
@@ -12,7 +18,7 @@ st.set_page_config(layout="wide")
 st.title("Simple Artefact chat")
 
 # Load OpenAI API key from Streamlit secrets
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+client = get_openai_client(st.secrets["OPENAI_API_KEY"])
 
 # Define the GPT model to be used
 GPT_MODEL = "gpt-4o-mini"
@@ -24,41 +30,35 @@ if 'letters' not in st.session_state:
     st.session_state['letters'] = ['']
 if 'letter_placeholder' not in st.session_state:
     st.session_state['letter_placeholder'] = ''
+if 'rate_limit_session' not in st.session_state:
+    st.session_state['rate_limit_session'] = uuid.uuid4().hex
+
+# Function to route parsed stream events to the chat pane or the letter pane
+def apply_letter_events(events, message_response):
+    for channel, text in events:
+        if channel == CHAT:
+            message_response += text
+        elif channel == LETTER:
+            st.session_state.letter_placeholder += text
+        elif channel == LETTER_START:
+            message_response += "Skriver brev..."
+    return message_response
 
 cola, colb = st.columns(2)
 
+# Create the letter pane up front so it can be updated while the reply streams
+with colb:
+    letter_pane = st.container(border=True, height=600).empty()
+
 user_input = st.chat_input("Svara ...")
 with cola:
     with st.container(border=True, height=600):
-        # Display previous chat messages
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                # st.markdown(message["content"])
-                if '<letter>' in message["content"] and '</letter>' in message["content"]:
-                    # Split the content into parts
-                    parts = re.split(r'(<letter>.*?</letter>)', message["content"], flags=re.DOTALL)
-                    
-                    # Display content before the letter
-                    if parts[0].strip():
-                        st.markdown(parts[0].strip())
-                    
-                    # Extract and display the letter content
-                    letter_content = re.search(r'<letter>(.*?)</letter>', parts[1], re.DOTALL)
-                    if letter_content:
-                        with st.expander("Brev"):
-                            st.markdown(letter_content.group(1))
-                    
-                    # Display content after the letter
-                    if len(parts) > 2 and parts[2].strip():
-                        st.markdown(parts[2].strip())
-                else:
-                    # If there's no letter tag, display the content as is
-                    st.markdown(message["content"])
-
-        
+        # Display previous chat messages from their pre-parsed segments
+        render_history(st.session_state.messages)
+
         if user_input:
             # Add user's message to session state
-            st.session_state.messages.append({"role": "user", "content": user_input})
+            st.session_state.messages.append(make_message("user", user_input))
             with st.chat_message("user"):
                 st.markdown(user_input)
 
@@ -67,35 +67,35 @@ with cola:
                 message_placeholder = st.empty()
                 full_response = ""
                 message_response = ""
-                completion = client.chat.completions.create(
-                    model=GPT_MODEL,
-                    messages=[SYSTEM_MESSAGE] + [
-                        {"role": m["role"], "content": m["content"]}
-                        for m in st.session_state.messages
-                    ],
-                    stream=True
+                prompt = [SYSTEM_MESSAGE] + [
+                    {"role": m["role"], "content": m["content"]}
+                    for m in st.session_state.messages
+                ]
+                completion = call_with_limits(
+                    get_rate_limiter(CHAT_ENDPOINT, GPT_MODEL),
+                    lambda: client.chat.completions.create(model=GPT_MODEL, messages=prompt, stream=True),
+                    estimate_tokens(json.dumps(prompt, ensure_ascii=False)) + DEFAULT_COMPLETION_RESERVE,
+                    session=st.session_state['rate_limit_session'],
                 )
+                letter_parser = LetterStreamParser()
+                renderer = RenderScheduler(st.secrets.get("render_max_hz", DEFAULT_MAX_HZ), st.secrets.get("render_flush_chars", DEFAULT_FLUSH_CHARS))
+                renderer.add("chat", message_placeholder)
+                renderer.add("letter", letter_pane)
                 for chunk in completion:
                     if chunk.choices[0].finish_reason == "stop": 
-                        message_placeholder.markdown(message_response)
+                        message_response = apply_letter_events(letter_parser.finish(), message_response)
                         if st.session_state.letter_placeholder != '': 
                             st.session_state.letters.append(st.session_state.letter_placeholder)
                         st.session_state.letter_placeholder = ''
+                        renderer.update(chat=message_response, letter=st.session_state.letters[-1])
+                        renderer.flush(final=True)
                         break
 
                     full_response += chunk.choices[0].delta.content
-                    
-                    if '<letter>' in full_response and '</letter>' not in full_response:
-                        message_response = message_response.replace('<letter','Skriver brev...')
-                        st.session_state.letter_placeholder += chunk.choices[0].delta.content
-                    else:
-                        message_response += chunk.choices[0].delta.content
-                    message_placeholder.markdown(message_response + "▌")
+                    message_response = apply_letter_events(letter_parser.feed(chunk.choices[0].delta.content), message_response)
+                    renderer.update(chat=message_response, letter=st.session_state.letter_placeholder or st.session_state.letters[-1])
 
             # Add bot's reply to session state
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
+            st.session_state.messages.append(make_message("assistant", full_response))
 
-with colb:
-    with st.container(border=True, height=600):
-        st.write(st.session_state['letter_placeholder'].replace('</letter',''))
-        st.write(st.session_state.letters[-1].replace('</letter',''))
\ No newline at end of file
+letter_pane.markdown(st.session_state['letter_placeholder'] or st.session_state.letters[-1])
@@ -1,9 +1,33 @@
+import uuid
+
 import streamlit as st
-from openai import OpenAI
-from qdrant_client import QdrantClient
-import re
-import json
-import requests
+from chat_render import make_message, render_history
+from clients import get_async_openai_client, get_directus_client, get_openai_client, get_qdrant_client
+from context_compaction import DEFAULT_KEEP_LAST_TURNS, DEFAULT_SUMMARY_MODEL, DEFAULT_TOKEN_CEILING, openai_summarizer
+from context_packer import DEFAULT_TOKEN_BUDGET
+from directus_log import DEFAULT_FLUSH_INTERVAL, DEFAULT_KEY_FIELD, DEFAULT_MAX_BATCH, DEFAULT_QUEUE_SIZE, get_directus_log_writer
+from directus_spool import DEFAULT_SPOOL_PATH, get_directus_spool
+from draft_engine import (
+    DoneEvent,
+    DraftEngine,
+    EngineConfig,
+    LetterStartEvent,
+    LetterTokenEvent,
+    TokenEvent,
+    ToolResultEvent,
+    ToolStartEvent,
+    iterate_events,
+)
+from embedding_backends import DEFAULT_LOCAL_MODEL, get_embedding_backend
+from embedding_cache import DEFAULT_CACHE_PATH
+from embedding_service import DEFAULT_BATCH_WINDOW
+from qdrant_search import DEFAULT_MAX_HIT_CHARS, DEFAULT_PAYLOAD_FIELDS, DEFAULT_SEARCH_TIMEOUT
+from rate_limiter import CHAT, EMBEDDINGS, get_rate_limiter
+from render_throttle import DEFAULT_FLUSH_CHARS, DEFAULT_MAX_HZ, RenderScheduler
+from retrieval import Retriever
+from semantic_cache import DEFAULT_SIMILARITY_THRESHOLD, DEFAULT_TTL, get_semantic_result_cache
+from sparse_index import DEFAULT_RRF_K, get_sparse_index
+from speculative_search import DEFAULT_MIN_OVERLAP, DEFAULT_REUSE_POLICY
 
 # Set page config
 st.set_page_config(layout="wide")
@@ -13,149 +37,106 @@ st.title("KFT utkastgenereraren")
 st.write("För att upprätthålla informationssäkerheten, skriv inte in personuppgifter eller känslig information i denna tjänst")
 
 # Load OpenAI API key from Streamlit secrets
-openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-qdrant_client = QdrantClient(url=st.secrets["qdrant_url"], port=443, api_key=st.secrets["qdrant_api_key"])
+openai_client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+async_openai_client = get_async_openai_client(st.secrets["OPENAI_API_KEY"])
+qdrant_client = get_qdrant_client(
+    st.secrets["qdrant_url"],
+    api_key=st.secrets["qdrant_api_key"],
+    prefer_grpc=st.secrets.get("qdrant_prefer_grpc", False),
+)
 directus_api_url = "https://nav.utvecklingfalkenberg.se/items/kft_bot"
 directus_params = {"access_token": st.secrets['directus_token']}
+directus_client = get_directus_client()
+directus_log = get_directus_log_writer(
+    directus_client,
+    directus_api_url,
+    directus_params,
+    spool=get_directus_spool(st.secrets.get("directus_spool_path", DEFAULT_SPOOL_PATH)),
+    queue_size=st.secrets.get("directus_queue_size", DEFAULT_QUEUE_SIZE),
+    max_batch=st.secrets.get("directus_max_batch", DEFAULT_MAX_BATCH),
+    flush_interval=st.secrets.get("directus_flush_interval", DEFAULT_FLUSH_INTERVAL),
+    key_field=st.secrets.get("directus_key_field", DEFAULT_KEY_FIELD),
+)
 
 # Define the GPT model to be used
 GPT_MODEL = "gpt-4o"
 EMBEDDING_MODEL = "text-embedding-3-large"
-
-# Function to safely parse JSON
-def safe_json_loads(json_string):
-    # Split the JSON string if multiple JSON objects are concatenated
-    json_objects = re.findall(r'\{.*?\}(?=\{|\Z)', json_string)
-    all_arguments = []
-
-    for obj in json_objects:
-        try:
-            parsed = json.loads(obj)
-            all_arguments.append(parsed)
-        except json.JSONDecodeError:
-            st.warning(f"Error parsing JSON from function arguments: {obj}. Using empty dict.")
-            all_arguments.append({})
-
-    return all_arguments
-
-# Function to generate embeddings
-def generate_embeddings(text):
-    try:
-        response = openai_client.embeddings.create(input=text, model=EMBEDDING_MODEL)
-        return response.data[0].embedding
-    except Exception as e:
-        st.error(f"Error generating embeddings: {str(e)}")
-        return None
-
-# Function to search Qdrant
-def search_collection(qdrant_client, collection_name, user_query_embedding, limit=3):
-    try:
-        response = qdrant_client.search(
-            collection_name=collection_name,
-            query_vector=user_query_embedding,
-            limit=limit,
-            with_payload=True
-        )
-        return response
-    except Exception as e:
-        st.error(f"Error searching Qdrant collection: {str(e)}")
-        return []
-
-# Tool call function
-def search_qdrant(user_input: str='', limit: int = 3):
-    if user_input == '': return ''
-    print('Searching', user_input)
-    user_query_embedding = generate_embeddings(user_input)
-    if user_query_embedding is None:
-        return []
-
-    results = search_collection(qdrant_client, 'FalkenbergsKommunsHemsida', user_query_embedding, limit)
-    results2 = search_collection(qdrant_client, 'mediawiki', user_query_embedding, limit)
-    formatted_results = []
-    for result in results:
-        formatted_results.append({
-            "score": result.score,
-            "payload": result.payload
-        })
-    for result in results2:
-        formatted_results.append({
-            "score": result.score,
-            "payload": result.payload
-        })
-
-    return formatted_results
-
-def submit_feedback(user_rating, user_feedback):
-    directus_api_url = "https://nav.utvecklingfalkenberg.se/items/kft_bot"
-    directus_params = {"access_token": st.secrets['directus_token']}
-    chat_history = "\n".join([
-        f"{m['role']}: {m['content']}" 
-        for m in st.session_state.messages 
-        if m['role'] != 'function'
-    ])
-    data = {
-        "prompt": chat_history,
-        "user_rating": user_rating,
-        "user_feedback": user_feedback
-    }
-    
-    try:
-        response = requests.post(directus_api_url, json=data, params=directus_params)
-        response.raise_for_status()
-        return True
-    except requests.RequestException as e:
-        st.error(f"Error submitting feedback: {str(e)}")
-        return False
-    
-
-# Set up tools
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "search_qdrant",
-            "description": "Search the falkenbergs kommuns databses/collections for policies and procedures. Use this when you need to find additional information to support the case worker.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "user_input": {
-                        "type": "string",
-                        "description": "Full context of the entire case including all possible keywords. 5 to 20 words of context",
-                        "example": "lekplats grönområde farligt barnlek trafikfara skötsel vägmärkesförordningen farthinder"
-                    },
-                    "limit": {
-                        "type": "integer",
-                        "description": "The number of similar results to return.",
-                        "default": 3
-                    }
-                },
-                "required": ["user_input"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "submit_feedback",
-            "description": "Submit user feedback to the CMS. Om du inte har tillräckligt information - fråga vilken feedback de vill lämna. Ranking 1-5.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "user_rating": {
-                        "type": "integer",
-                        "description": "User rating (1-5 stars)",
-                        "enum": [1,2,3,4,5]
-                    },
-                    "user_feedback": {
-                        "type": "string",
-                        "description": "User's textual feedback"
-                    }
-                },
-                "required": ["user_rating", "user_feedback"]
-            }
-        }
-    }
-]
+SEARCH_COLLECTIONS = st.secrets.get("search_collections", ["FalkenbergsKommunsHemsida", "mediawiki"])
+SEARCH_TIMEOUT = st.secrets.get("search_timeout", DEFAULT_SEARCH_TIMEOUT)
+PAYLOAD_FIELDS = st.secrets.get("payload_fields", DEFAULT_PAYLOAD_FIELDS)
+MAX_HIT_CHARS = st.secrets.get("max_hit_chars", DEFAULT_MAX_HIT_CHARS)
+CONTEXT_TOKEN_BUDGET = st.secrets.get("context_token_budget", DEFAULT_TOKEN_BUDGET)
+RENDER_MAX_HZ = st.secrets.get("render_max_hz", DEFAULT_MAX_HZ)
+RENDER_FLUSH_CHARS = st.secrets.get("render_flush_chars", DEFAULT_FLUSH_CHARS)
+PROMPT_TOKEN_CEILING = st.secrets.get("prompt_token_ceiling", DEFAULT_TOKEN_CEILING)
+KEEP_LAST_TURNS = st.secrets.get("keep_last_turns", DEFAULT_KEEP_LAST_TURNS)
+MAX_TOOL_ROUNDS = st.secrets.get("max_tool_rounds", 2)
+RETRIEVAL_FIRST = st.secrets.get("retrieval_first", False)
+SPECULATIVE_RETRIEVAL = st.secrets.get("speculative_retrieval", False)
+SPECULATIVE_REUSE_POLICY = st.secrets.get("speculative_reuse_policy", DEFAULT_REUSE_POLICY)
+SPECULATIVE_MIN_OVERLAP = st.secrets.get("speculative_min_overlap", DEFAULT_MIN_OVERLAP)
+LOG_INTERACTIONS = st.secrets.get("log_interactions", False)
+HYBRID_SEARCH = st.secrets.get("hybrid_search", True)
+# Process-wide OpenAI rate limits per model, shared by every session; response headers keep them in sync
+get_rate_limiter(CHAT, GPT_MODEL, rpm=st.secrets.get("chat_rpm"), tpm=st.secrets.get("chat_tpm"))
+get_rate_limiter(EMBEDDINGS, EMBEDDING_MODEL, rpm=st.secrets.get("embedding_rpm"), tpm=st.secrets.get("embedding_tpm"))
+summarize_conversation = openai_summarizer(openai_client, st.secrets.get("summary_model", DEFAULT_SUMMARY_MODEL))
+result_cache = get_semantic_result_cache(
+    threshold=st.secrets.get("result_cache_threshold", DEFAULT_SIMILARITY_THRESHOLD),
+    ttl=st.secrets.get("result_cache_ttl", DEFAULT_TTL),
+)
+embedding_backend = get_embedding_backend(
+    st.secrets.get("embedding_backend", "openai"),
+    openai_client=openai_client,
+    openai_model=EMBEDDING_MODEL,
+    local_model=st.secrets.get("local_embedding_model", DEFAULT_LOCAL_MODEL),
+    cache_path=st.secrets.get("embedding_cache_path", DEFAULT_CACHE_PATH),
+    batch_window=st.secrets.get("embedding_batch_window", DEFAULT_BATCH_WINDOW),
+)
+
+# Set up the draft engine; the pipeline itself lives in draft_engine.py
+retriever = Retriever(
+    embedding_backend,
+    qdrant_client,
+    collections=SEARCH_COLLECTIONS,
+    timeout=SEARCH_TIMEOUT,
+    result_cache=result_cache,
+    payload_fields=PAYLOAD_FIELDS,
+    max_hit_chars=MAX_HIT_CHARS,
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    model=GPT_MODEL,
+    sparse_index=get_sparse_index(qdrant_client, SEARCH_COLLECTIONS, payload_fields=PAYLOAD_FIELDS) if HYBRID_SEARCH else None,
+    fusion_k=st.secrets.get("fusion_k", DEFAULT_RRF_K),
+)
+engine = DraftEngine(
+    async_openai_client,
+    retriever,
+    config=EngineConfig(
+        model=GPT_MODEL,
+        max_tool_rounds=MAX_TOOL_ROUNDS,
+        retrieval_first=RETRIEVAL_FIRST,
+        speculative_retrieval=SPECULATIVE_RETRIEVAL,
+        reuse_policy=SPECULATIVE_REUSE_POLICY,
+        min_overlap=SPECULATIVE_MIN_OVERLAP,
+        token_ceiling=PROMPT_TOKEN_CEILING,
+        keep_last_turns=KEEP_LAST_TURNS,
+        log_interactions=LOG_INTERACTIONS,
+    ),
+    summarize=summarize_conversation,
+    log_writer=directus_log,
+)
+
+# Function to show search errors reported by the engine
+def show_errors(errors):
+    for name, error in errors.items():
+        if name == "embedding":
+            st.error(f"Error generating embeddings: {error}")
+        else:
+            st.error(f"Error searching Qdrant collection {name}: {error}")
+
+# Function to get the letter currently shown in the letter pane
+def current_letter():
+    return st.session_state.letter_placeholder or st.session_state.letters[-1]
 
 # Initialize session state for storing chat messages if not already set
 if 'messages' not in st.session_state:
@@ -164,186 +145,66 @@ if 'letters' not in st.session_state:
     st.session_state['letters'] = ['']
 if 'letter_placeholder' not in st.session_state:
     st.session_state['letter_placeholder'] = ''
-if 'current_tool_call' not in st.session_state:
-    st.session_state['current_tool_call'] = {'name': None, 'arguments': ''}
-
-
-
+if 'compaction' not in st.session_state:
+    st.session_state['compaction'] = {}
+if 'rate_limit_session' not in st.session_state:
+    st.session_state['rate_limit_session'] = uuid.uuid4().hex
 
-SYSTEM_MESSAGE = {
-    "role": "system",
-    "content": "Du är en hjälpsam assistent som hjälper en kommunanställd att författa ett svar till en invånare. Givet invånarfrågan, sammanställ relevant fakta på ett lättläst sätt, samt ge ett utkast på hur ett svar skulle kunna se ut. Ditt svar riktas till en anställd på kommunen och ska utgöra ett stöd för den anställde att återkoppla direkt till den som ställer frågan. Om du har rätt fakta för att ge ett korrekt svar, skriv det. Om inte, skriv att kommunen har tagit emot synpunkten och diariefört den men att det inte är säkert att det finns resurser att prioritera just denna fråga. Inkludera alltid källor. Svara vänligt men kortfattat. Svaret börjar med: 'Hej Namn,' och avslutas med: 'Med vänliga hälsningar, [Namn], [Avdelning på kommunen]'. Svaret ska formateras i markdown och markeras inom tags <letter>[letter content in markdown]</letter>, efter closing tag lista länk till källorna som du har baserat ditt svar på. Svaret ska aldrig hänvisa tillbaka till en specifik person, hänvisa om nödvändigt till kontaktcenter  Tel: 0346-88 60 00 Mejl: kontaktcenter@falkenberg.se. När du är ombedd kan du samla in feedback från användaren. Bekräfta för användaren om du har skickat in feedback."
-}
 
 cola, colb = st.columns(2)
 
+# Create the letter pane up front so it can be updated while the reply streams
+with colb:
+    letter_pane = st.container(border=True, height=600).empty()
+
 user_input = st.chat_input("Skriv medborgarfråga eller instruktioner här ...")
 with cola:
     with st.container(border=True, height=600):
-        # Display previous chat messages
-        for message in st.session_state.messages:
-            if message["role"] == "function":
-                continue
-            with st.chat_message(message["role"]):
-                # st.markdown(message["content"])
-                if '<letter>' in message["content"] and '</letter>' in message["content"]:
-                    # Split the content into parts
-                    parts = re.split(r'(<letter>.*?</letter>)', message["content"], flags=re.DOTALL)
-
-                    # Display content before the letter
-                    if parts[0].strip():
-                        st.markdown(parts[0].strip())
-
-                    # Extract and display the letter content
-                    letter_content = re.search(r'<letter>(.*?)</letter>', parts[1], re.DOTALL)
-                    if letter_content:
-                        with st.expander("Brev"):
-                            st.markdown(letter_content.group(1))
-
-                    # Display content after the letter
-                    if len(parts) > 2 and parts[2].strip():
-                        st.markdown(parts[2].strip())
-                else:
-                    # If there's no letter tag, display the content as is
-                    st.markdown(message["content"])
-
+        # Display previous chat messages from their pre-parsed segments
+        render_history(st.session_state.messages)
 
         if user_input:
             # Add user's message to session state
-            st.session_state.messages.append({"role": "user", "content": user_input})
+            st.session_state.messages.append(make_message("user", user_input))
             with st.chat_message("user"):
                 st.markdown(user_input)
 
-            # Stream the GPT-4 reply
+            # Stream the reply from the draft engine
             with st.chat_message("assistant"):
                 message_placeholder = st.empty()
-                full_response = ""
                 message_response = ""
-                completion = openai_client.chat.completions.create(
-                    model=GPT_MODEL,
-                    messages=[SYSTEM_MESSAGE] + [
-                        {"role": m["role"],
-                        "content": m["content"],
-                        **({"name": m["name"]} if m["role"] == "function" else {})
-                        }
-                        for m in st.session_state.messages
-                    ],
-                    stream=True,
-                    tools=tools,
-                    temperature=0.2,
-                    tool_choice="auto",
-                )
-
-
-                # Handle text completions
-                for chunk in completion:
-                    # Handle tool call
-                    choice = chunk.choices[0]
-                    if choice.delta.tool_calls:
-
-                        tool_call = choice.delta.tool_calls[0]
-
-                        # Accumulate tool call arguments
-                        if tool_call.function.arguments is not None:
-                            st.session_state['current_tool_call']['arguments'] += tool_call.function.arguments
-
-                        # Capture the tool call function name
-                        if tool_call.function.name is not None:
-                            st.session_state['current_tool_call']['name'] = tool_call.function.name
-
-                        # Continue to accumulate tool call arguments until all parts are received
-                        continue
-
-                    # When the tool call is complete, execute the tool function
-                    if choice.finish_reason == "tool_calls" and st.session_state['current_tool_call']['name']:
-                        function_name = st.session_state['current_tool_call']['name']
-                        function_args_list = safe_json_loads(st.session_state['current_tool_call']['arguments'])
-
-                        for function_args in function_args_list:
-                            # Perform the tool function based on the function name
-                            if function_name == "search_qdrant":
-                                search_results = search_qdrant(**function_args)
-                                st.session_state.messages.append({
-                                    "role": "function",
-                                    "name": "search_qdrant",
-                                    "content": json.dumps(search_results)
-                                })
-                            elif function_name == "submit_feedback":
-                                success = submit_feedback(function_args['user_rating'], function_args['user_feedback'])
-                                st.session_state.messages.append({
-                                    "role": "function",
-                                    "name": "submit_feedback",
-                                    "content": json.dumps({"success": success})
-                                })
-                                # Add a message to the chat indicating that feedback is being submitted
-                                message_response += "Skickar in feedback...\n"
-                                message_placeholder.markdown(message_response + "▌")
-
-                        # Reset tool call state for future calls
-                        st.session_state['current_tool_call'] = {'name': None, 'arguments': ''}
-                        # Call openai and give it the function output
-                        completion = openai_client.chat.completions.create(
-                            model=GPT_MODEL,
-                            messages=[SYSTEM_MESSAGE] + [
-                                {"role": m["role"],
-                                "content": m["content"],
-                                **({"name": m["name"]} if m["role"] == "function" else {})
-                                }
-
-                                for m in st.session_state.messages
-                            ],
-                            stream=True,
-                            tools=tools,
-                            temperature=0.2,
-                            tool_choice="auto",
-                        )
-                        for chunk in completion:
-                            choice = chunk.choices[0]
-                            if choice.finish_reason == "stop":
-                                message_placeholder.markdown(message_response)
-                                if st.session_state.letter_placeholder != '':
-                                    st.session_state.letters.append(st.session_state.letter_placeholder)
-                                st.session_state.letter_placeholder = ''
-                                break
-
-                            if choice.delta.content:
-                                full_response += choice.delta.content
-
-                                if '<letter>' in full_response and '</letter>' not in full_response:
-                                    message_response = message_response.replace('<letter','Skriver brev...')
-                                    st.session_state.letter_placeholder += choice.delta.content
-                                else:
-                                    message_response += choice.delta.content
-                                message_placeholder.markdown(message_response + "▌")
-                        break
-
-                    if choice.finish_reason == "stop":
-                        message_placeholder.markdown(message_response)
-                        if st.session_state.letter_placeholder != '':
-                            st.session_state.letters.append(st.session_state.letter_placeholder)
-                        st.session_state.letter_placeholder = ''
-                        break
-
-                    if choice.delta.content:
-                        full_response += choice.delta.content
-
-                        if '<letter>' in full_response and '</letter>' not in full_response:
-                            message_response = message_response.replace('<letter','Skriver brev...')
-                            st.session_state.letter_placeholder += choice.delta.content
-                        else:
-                            message_response += choice.delta.content
-                        message_placeholder.markdown(message_response + "▌")
-
-            # Add bot's reply to session state
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
-
-    with colb:
-        with st.container(border=True, height=600):
-            if st.session_state.letter_placeholder:
-                letter_content = st.session_state.letter_placeholder.replace('</letter', '').replace('>','')
-            elif st.session_state.letters:
-                letter_content = st.session_state.letters[-1].replace('</letter', '').replace('>','')
-            else:
-                letter_content = ""
+                status = ""
+                renderer = RenderScheduler(RENDER_MAX_HZ, RENDER_FLUSH_CHARS)
+                renderer.add("chat", message_placeholder)
+                renderer.add("letter", letter_pane)
+                for event in iterate_events(engine.run(st.session_state.messages, st.session_state['compaction'], st.session_state['rate_limit_session'])):
+                    if isinstance(event, TokenEvent):
+                        message_response += event.text
+                    elif isinstance(event, LetterStartEvent):
+                        message_response += "Skriver brev..."
+                    elif isinstance(event, LetterTokenEvent):
+                        st.session_state.letter_placeholder += event.text
+                    elif isinstance(event, ToolStartEvent):
+                        if event.name == "submit_feedback":
+                            # Add a message to the chat indicating that feedback is being submitted
+                            message_response += "Skickar in feedback...\n"
+                        elif not message_response:
+                            status = "Söker underlag..."
+                    elif isinstance(event, ToolResultEvent):
+                        show_errors(event.errors)
+                    elif isinstance(event, DoneEvent):
+                        # Add tool calls, their results and the bot's reply to session state
+                        st.session_state.messages.extend(event.messages)
+                    renderer.update(chat=message_response or status, letter=current_letter())
+                    # Always show what has streamed so far before a tool runs and once it has finished
+                    if isinstance(event, (ToolStartEvent, ToolResultEvent)):
+                        renderer.flush()
+
+                if st.session_state.letter_placeholder != '':
+                    st.session_state.letters.append(st.session_state.letter_placeholder)
+                st.session_state.letter_placeholder = ''
+                renderer.update(chat=message_response, letter=current_letter())
+                renderer.flush(final=True)
+
+letter_pane.markdown(current_letter())
 
-            st.write(letter_content)
@@ -0,0 +1,191 @@
+import threading
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from qdrant_client import QdrantClient
+
+from rate_limiter import endpoint_name, get_rate_limiter, request_model
+
+# Process-wide client registry. Streamlit re-executes page scripts on every rerun, but
+# imported modules are loaded once per process, so clients created here (and their
+# connection pools) are shared by every rerun and every session.
+
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_KEEPALIVE = 32
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+DEFAULT_HTTP_TIMEOUT = 60.0
+
+_clients = {}
+_clients_lock = threading.Lock()
+_max_seen_streams = 4096
+
+
+class ConnectionStats:
+    # Counts requests and how many of them reused an already open connection
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen_streams = set()
+        self.requests = 0
+        self.new_connections = 0
+
+    def record(self, response):
+        stream = response.extensions.get("network_stream")
+        with self._lock:
+            self.requests += 1
+            if stream is None:
+                return
+            stream_id = id(stream)
+            if stream_id not in self._seen_streams:
+                self.new_connections += 1
+                if len(self._seen_streams) >= _max_seen_streams:
+                    self._seen_streams.clear()
+                self._seen_streams.add(stream_id)
+
+    def snapshot(self):
+        with self._lock:
+            reused = self.requests - self.new_connections
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+
+# Function to feed OpenAI's rate-limit headers to the process-wide limiter for the endpoint and model
+def observe_rate_limits(response):
+    model = request_model(response.request)
+    if model:
+        get_rate_limiter(endpoint_name(response.request.url.path), model).observe(response.headers, response.status_code)
+
+
+def _get_or_create(key, factory):
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            entry = factory()
+            _clients[key] = entry
+        return entry["client"]
+
+
+# Function to get a pooled OpenAI client with HTTP/2 keep-alive
+def get_openai_client(
+    api_key,
+    base_url=None,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    max_keepalive=DEFAULT_MAX_KEEPALIVE,
+    http2=True,
+):
+    def factory():
+        stats = ConnectionStats()
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+        )
+        http_client = httpx.Client(
+            http2=http2,
+            limits=limits,
+            timeout=DEFAULT_HTTP_TIMEOUT,
+            event_hooks={"response": [stats.record, observe_rate_limits]},
+        )
+        # rate_limiter.call_with_limits is the only retry layer, so retries wait for the limiter
+        client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        return {
+            "kind": "openai",
+            "client": client,
+            "stats": stats,
+            "config": {"http2": http2, "max_connections": max_connections, "max_keepalive": max_keepalive},
+        }
+
+    return _get_or_create(("openai", api_key, base_url), factory)
+
+
+# Function to get a pooled asyncio OpenAI client for code running on an event loop.
+# Its connections belong to the loop that first uses it, so use one long-lived loop per process.
+def get_async_openai_client(
+    api_key,
+    base_url=None,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    max_keepalive=DEFAULT_MAX_KEEPALIVE,
+    http2=True,
+):
+    def factory():
+        stats = ConnectionStats()
+
+        async def record(response):
+            stats.record(response)
+            observe_rate_limits(response)
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+        )
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=limits,
+            timeout=DEFAULT_HTTP_TIMEOUT,
+            event_hooks={"response": [record]},
+        )
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        return {
+            "kind": "openai_async",
+            "client": client,
+            "stats": stats,
+            "config": {"http2": http2, "max_connections": max_connections, "max_keepalive": max_keepalive},
+        }
+
+    return _get_or_create(("openai_async", api_key, base_url), factory)
+
+
+# Function to get a shared Qdrant client, optionally over gRPC
+def get_qdrant_client(url, api_key=None, port=443, prefer_grpc=False, grpc_port=6334):
+    def factory():
+        client = QdrantClient(url=url, port=port, grpc_port=grpc_port, prefer_grpc=prefer_grpc, api_key=api_key)
+        return {
+            "kind": "qdrant",
+            "client": client,
+            "stats": None,
+            "config": {"transport": "grpc" if prefer_grpc else "rest"},
+        }
+
+    return _get_or_create(("qdrant", url, api_key, prefer_grpc), factory)
+
+
+# Function to get a pooled HTTP/2 keep-alive client for Directus
+def get_directus_client(max_connections=DEFAULT_MAX_KEEPALIVE, http2=True):
+    def factory():
+        stats = ConnectionStats()
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+        )
+        client = httpx.Client(
+            http2=http2,
+            limits=limits,
+            timeout=DEFAULT_HTTP_TIMEOUT,
+            event_hooks={"response": [stats.record]},
+        )
+        return {
+            "kind": "directus",
+            "client": client,
+            "stats": stats,
+            "config": {"http2": http2, "max_connections": max_connections},
+        }
+
+    return _get_or_create(("directus", max_connections, http2), factory)
+
+
+# Function to report pool configuration and connection reuse for every registered client
+def client_metrics():
+    with _clients_lock:
+        entries = list(_clients.items())
+    metrics = []
+    for key, entry in entries:
+        item = {"kind": entry["kind"], **entry["config"]}
+        if entry["stats"] is not None:
+            item.update(entry["stats"].snapshot())
+        metrics.append(item)
+    return metrics
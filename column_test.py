@@ -1,16 +1,22 @@
+import uuid
+
 import streamlit as st
 import streamlit.components.v1 as components
-from openai import OpenAI
-from qdrant_client import QdrantClient
+from clients import get_openai_client, get_qdrant_client
 import requests
 import json
+from rate_limiter import CHAT, DEFAULT_COMPLETION_RESERVE, EMBEDDINGS, call_with_limits, estimate_tokens, get_rate_limiter
 
 # Set page config
 st.set_page_config(page_title="AI Chat with Qdrant Search", layout="wide")
 
 # Set up OpenAI and Qdrant clients
-openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-qdrant_client = QdrantClient(url=st.secrets["qdrant_url"], port=443, api_key=st.secrets["qdrant_api_key"])
+openai_client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+qdrant_client = get_qdrant_client(
+    st.secrets["qdrant_url"],
+    api_key=st.secrets["qdrant_api_key"],
+    prefer_grpc=st.secrets.get("qdrant_prefer_grpc", False),
+)
 
 # Constants
 GPT_MODEL = "gpt-4o"  # Make sure this is the correct model name
@@ -19,7 +25,12 @@ EMBEDDING_MODEL = "text-embedding-3-large"
 # Function to generate embeddings
 def generate_embeddings(text):
     try:
-        response = openai_client.embeddings.create(input=text, model=EMBEDDING_MODEL)
+        response = call_with_limits(
+            get_rate_limiter(EMBEDDINGS, EMBEDDING_MODEL),
+            lambda: openai_client.embeddings.create(input=text, model=EMBEDDING_MODEL),
+            estimate_tokens(text),
+            session=st.session_state['rate_limit_session'],
+        )
         return response.data[0].embedding
     except Exception as e:
         st.error(f"Error generating embeddings: {str(e)}")
@@ -28,13 +39,13 @@ def generate_embeddings(text):
 # Function to search Qdrant
 def search_collection(qdrant_client, collection_name, user_query_embedding, limit=5):
     try:
-        response = qdrant_client.search(
+        response = qdrant_client.query_points(
             collection_name=collection_name,
-            query_vector=user_query_embedding,
+            query=user_query_embedding,
             limit=limit,
             with_payload=True
         )
-        return response
+        return response.points
     except Exception as e:
         st.error(f"Error searching Qdrant collection: {str(e)}")
         return []
@@ -58,11 +69,16 @@ def search_qdrant(user_input: str, collection_name: str, limit: int = 5):
 # Function to handle AI response generation
 def generate_ai_response(messages):
     try:
-        completion = openai_client.chat.completions.create(
-            model=GPT_MODEL,
-            messages=messages,
-            tools=tools,
-            tool_choice="auto",
+        completion = call_with_limits(
+            get_rate_limiter(CHAT, GPT_MODEL),
+            lambda: openai_client.chat.completions.create(
+                model=GPT_MODEL,
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+            ),
+            estimate_tokens(json.dumps(messages, ensure_ascii=False)) + DEFAULT_COMPLETION_RESERVE,
+            session=st.session_state['rate_limit_session'],
         )
         return completion
     except Exception as e:
@@ -90,6 +106,9 @@ if 'last_letter' not in st.session_state:
 if 'tool_calls' not in st.session_state:
     st.session_state['tool_calls'] = []
 
+if 'rate_limit_session' not in st.session_state:
+    st.session_state['rate_limit_session'] = uuid.uuid4().hex
+
 # Generate HTML for independent scrolling
 scrollable_messages = "<br>".join([f"<p>{message['role']}: {message['content']}</p>" for message in st.session_state['messages'] if message["role"] != "function"])
 last_letter = st.session_state['last_letter'] if st.session_state['last_letter'] else "No draft letter to display yet."
@@ -0,0 +1,111 @@
+import json
+
+from context_packer import count_tokens
+from rate_limiter import CHAT, DEFAULT_COMPLETION_RESERVE, call_with_limits, get_rate_limiter
+from result_store import api_message, summarize_results
+
+DEFAULT_TOKEN_CEILING = 6000
+DEFAULT_KEEP_LAST_TURNS = 3
+DEFAULT_SUMMARY_MODEL = "gpt-4o-mini"
+MESSAGE_OVERHEAD_TOKENS = 4
+# Summaries queue for the chat limiter as their own session, beside the conversations
+SUMMARY_SESSION = "summary"
+
+SUMMARY_INSTRUCTIONS = (
+    "Du sammanfattar en pågående konversation mellan en kommunanställd och en assistent som skriver "
+    "utkast till svar till invånare. Uppdatera den befintliga sammanfattningen med de nya meddelandena. "
+    "Behåll invånarens ärende, viktiga fakta, beslut, önskemål om ändringar och vilka källor som använts. "
+    "Skriv kortfattat på svenska, högst 200 ord."
+)
+
+
+# Function to replace a stale tool result with a short list of the sources it contained
+def citation_stub(message):
+    if "result_handle" in message:
+        # Results kept out of band already carry their summary as content
+        return {key: value for key, value in message.items() if key != "result_handle"}
+    try:
+        results = json.loads(message["content"])
+    except (TypeError, ValueError):
+        results = None
+    return {**message, "content": summarize_results(message.get("name", "verktyg"), results)}
+
+
+# Function to group messages into turns, each starting at a user message
+def split_turns(messages):
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _message_tokens(message, model):
+    return count_tokens(message.get("content") or "", model) + MESSAGE_OVERHEAD_TOKENS
+
+
+# Function to build a summarizer that folds new messages into the rolling summary with one API call
+def openai_summarizer(openai_client, model=DEFAULT_SUMMARY_MODEL):
+    def summarize(previous_summary, messages):
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages if m.get("content"))
+        prompt = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Befintlig sammanfattning:\n{previous_summary or '(ingen)'}\n\nNya meddelanden:\n{transcript}"},
+        ]
+        completion = call_with_limits(
+            get_rate_limiter(CHAT, model),
+            lambda: openai_client.chat.completions.create(model=model, messages=prompt, temperature=0),
+            count_tokens(SUMMARY_INSTRUCTIONS + prompt[1]["content"]) + DEFAULT_COMPLETION_RESERVE,
+            session=SUMMARY_SESSION,
+        )
+        return completion.choices[0].message.content
+    return summarize
+
+
+# Function to build the prompt for the next request: the last turns verbatim, tool results
+# from earlier turns as citation stubs, and older turns folded into a rolling summary once
+# the prompt would exceed token_ceiling. state is a per-session dict that keeps the summary.
+def compact_messages(
+    system_message,
+    messages,
+    state,
+    summarize,
+    token_ceiling=DEFAULT_TOKEN_CEILING,
+    keep_last_turns=DEFAULT_KEEP_LAST_TURNS,
+    model="gpt-4o",
+):
+    turns = split_turns(messages)
+    if state.get("summarized_turns", 0) > len(turns):
+        state.clear()
+    state.setdefault("summary", "")
+    state.setdefault("summarized_turns", 0)
+    for index, turn in enumerate(turns[:-1]):
+        turns[index] = [citation_stub(m) if m["role"] in ("function", "tool") else m for m in turn]
+
+    def build(first_turn):
+        prompt = [system_message]
+        if state["summary"]:
+            prompt.append({"role": "system", "content": f"Sammanfattning av tidigare konversation: {state['summary']}"})
+        for turn in turns[first_turn:]:
+            prompt.extend(api_message(m) for m in turn)
+        return prompt
+
+    first_turn = state["summarized_turns"]
+    prompt = build(first_turn)
+    total = sum(_message_tokens(m, model) for m in prompt)
+    # Fold the oldest unsummarized turns into the summary until the prompt fits
+    while total > token_ceiling and len(turns) - first_turn > keep_last_turns:
+        fold_until = max(first_turn + 1, len(turns) - keep_last_turns)
+        folded = [m for turn in turns[first_turn:fold_until] for m in turn]
+        try:
+            state["summary"] = summarize(state["summary"], folded)
+        except Exception as e:
+            print(f"Could not summarize conversation: {e}")
+            break
+        first_turn = state["summarized_turns"] = fold_until
+        prompt = build(first_turn)
+        total = sum(_message_tokens(m, model) for m in prompt)
+
+    state["last_prompt_tokens"] = total
+    return prompt
@@ -0,0 +1,106 @@
+import json
+import re
+from functools import lru_cache
+
+import tiktoken
+
+DEFAULT_TOKEN_BUDGET = 3000
+DEFAULT_MMR_LAMBDA = 0.7
+DEFAULT_REDUNDANCY_THRESHOLD = 0.6
+SHINGLE_SIZE = 3
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads its BPE file on first use; without it fall back to an estimate
+        print(f"Could not load tokenizer for {model}, estimating tokens: {e}")
+        return None
+
+
+# Function to count tokens locally with the tokenizer of the chat model
+def count_tokens(text, model="gpt-4o"):
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# Function to turn a text into a set of word shingles for overlap detection
+def shingles(text, size=SHINGLE_SIZE):
+    words = re.findall(r"\w+", (text or "").lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+# Function to pick hits for the prompt: MMR over chunk overlap, then fill a token budget.
+# results are {"score", "payload"} dicts; returns (kept_results_in_score_order, report).
+def pack_context(
+    results,
+    token_budget=DEFAULT_TOKEN_BUDGET,
+    model="gpt-4o",
+    text_field="chunk",
+    mmr_lambda=DEFAULT_MMR_LAMBDA,
+    redundancy_threshold=DEFAULT_REDUNDANCY_THRESHOLD,
+):
+    candidates = []
+    for position, result in enumerate(results):
+        payload = result.get("payload") or {}
+        candidates.append({
+            "position": position,
+            "result": result,
+            "tokens": count_tokens(json.dumps(result, ensure_ascii=False), model),
+            "shingles": shingles(payload.get(text_field, "")),
+        })
+    scores = [candidate["result"].get("score", 0.0) for candidate in candidates]
+    top, bottom = (max(scores), min(scores)) if scores else (0.0, 0.0)
+    spread = (top - bottom) or 1.0
+
+    selected = []
+    report = {
+        "candidates": len(candidates),
+        "kept": 0,
+        "dropped_redundant": 0,
+        "dropped_budget": 0,
+        "tokens_used": 0,
+        "tokens_dropped": 0,
+        "token_budget": token_budget,
+    }
+    remaining = list(candidates)
+    while remaining:
+        best = None
+        best_value = None
+        best_overlap = 0.0
+        for candidate in remaining:
+            relevance = (candidate["result"].get("score", 0.0) - bottom) / spread
+            overlap = max((_similarity(candidate["shingles"], chosen["shingles"]) for chosen in selected), default=0.0)
+            value = mmr_lambda * relevance - (1 - mmr_lambda) * overlap
+            if best_value is None or value > best_value:
+                best, best_value, best_overlap = candidate, value, overlap
+        remaining.remove(best)
+        if best_overlap >= redundancy_threshold:
+            report["dropped_redundant"] += 1
+            report["tokens_dropped"] += best["tokens"]
+        elif report["tokens_used"] + best["tokens"] > token_budget:
+            report["dropped_budget"] += 1
+            report["tokens_dropped"] += best["tokens"]
+        else:
+            selected.append(best)
+            report["tokens_used"] += best["tokens"]
+
+    report["kept"] = len(selected)
+    report["dropped_hits"] = report["dropped_redundant"] + report["dropped_budget"]
+    selected.sort(key=lambda candidate: candidate["position"])
+    return [candidate["result"] for candidate in selected], report
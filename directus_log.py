@@ -0,0 +1,253 @@
+import atexit
+import random
+import threading
+import time
+
+import httpx
+
+from directus_spool import get_directus_spool
+
+DEFAULT_QUEUE_SIZE = 100000
+DEFAULT_MAX_BATCH = 50
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 60.0
+# Directus field that stores each create's idempotency key. The collection needs this one
+# extra field before the writer is deployed: for kft_bot, add "idempotency_key" as a string
+# input field (unique, hidden in the app). An empty key_field turns the duplicate check off,
+# and creates replayed after a timeout may then be stored twice.
+DEFAULT_KEY_FIELD = "idempotency_key"
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+CREATE = "create"
+UPDATE = "update"
+
+SENT = "sent"
+RETRY = "retry"
+REJECTED = "rejected"
+
+
+class DirectusLogWriter:
+    # Background writer for Directus items. Callers append creates and updates to the durable
+    # spool and return at once; a daemon thread replays the spool, sending pending creates as
+    # one bulk POST and pending updates as one bulk PATCH per batch. While Directus is down
+    # records stay in the spool and the worker backs off exponentially with jitter. With a
+    # key_field, creates carry their idempotency key in it and records that were already
+    # attempted are checked against Directus first, so a replay after a crash or timeout does
+    # not duplicate them.
+    # Items are dropped (and counted) only when queue_size records are already pending.
+    def __init__(
+        self,
+        client,
+        collection_url,
+        params=None,
+        spool=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        max_batch=DEFAULT_MAX_BATCH,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        backoff=DEFAULT_BACKOFF,
+        key_field=DEFAULT_KEY_FIELD,
+    ):
+        self.client = client
+        self.collection_url = collection_url
+        self.params = params or {}
+        self.spool = spool or get_directus_spool()
+        self.queue_size = queue_size
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.backoff = backoff
+        self.key_field = key_field
+        self._lock = threading.Lock()
+        self._pending = self.spool.counts()["pending"]
+        self._failures = 0
+        self._counters = {
+            "enqueued": 0,
+            "dropped": 0,
+            "sent": 0,
+            "duplicates": 0,
+            "unchecked_replays": 0,
+            "rejected": 0,
+            "retries": 0,
+            "flushes": 0,
+            "flush_seconds": 0.0,
+            "last_flush_seconds": 0.0,
+        }
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="directus-log", daemon=True)
+        self._worker.start()
+        if not self.key_field:
+            print(f"WARNING: Directus writer for {collection_url} has no key_field; replayed creates can be duplicated")
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+
+    def _enqueue(self, operation, item, key):
+        with self._lock:
+            if self._pending >= self.queue_size:
+                self._counters["dropped"] += 1
+                print(f"Directus spool full, dropped {operation}")
+                return None
+        key, stored = self.spool.append(operation, item, key)
+        # A key that is already spooled adds no row
+        if stored:
+            with self._lock:
+                self._pending += 1
+                self._counters["enqueued"] += 1
+            self._wakeup.set()
+        return key
+
+    # Spool a new item; returns its idempotency key once it is stored locally (None if dropped)
+    def create(self, item, key=None):
+        return self._enqueue(CREATE, item, key)
+
+    # Spool changes to an existing item; returns their idempotency key (None if dropped)
+    def update(self, item_id, changes, key=None):
+        return self._enqueue(UPDATE, {**changes, "id": item_id}, key)
+
+    # Send one bulk request; connection errors, 429 and 5xx are retried later
+    def _send(self, method, items):
+        try:
+            response = self.client.request(method, self.collection_url, json=items, params=self.params, timeout=30)
+            if response.status_code in RETRY_STATUS_CODES:
+                print(f"Directus {method} failed (HTTP {response.status_code}), will retry")
+                return RETRY
+            response.raise_for_status()
+            return SENT
+        except httpx.HTTPStatusError as e:
+            print(f"Directus rejected {len(items)} items: {e}")
+            return REJECTED
+        except httpx.RequestError as e:
+            print(f"Directus {method} failed ({e}), will retry")
+            return RETRY
+
+    # Function to find which of the given idempotency keys Directus already has
+    def _existing_keys(self, keys):
+        params = {
+            **self.params,
+            f"filter[{self.key_field}][_in]": ",".join(keys),
+            "fields": self.key_field,
+            "limit": len(keys),
+        }
+        response = self.client.get(self.collection_url, params=params, timeout=30)
+        if response.status_code in RETRY_STATUS_CODES:
+            raise httpx.RequestError(f"HTTP {response.status_code}")
+        response.raise_for_status()
+        return {row[self.key_field] for row in response.json().get("data", [])}
+
+    def _deliver(self, operation, method, records):
+        if operation == CREATE and self.key_field:
+            retried = [record["key"] for record in records if record["attempts"] > 0]
+            if retried:
+                try:
+                    existing = self._existing_keys(retried)
+                except httpx.HTTPStatusError as e:
+                    # A 4xx will not go away on retry (e.g. key_field is not a field of the
+                    # collection), so send without the check rather than block the spool
+                    print(f"Directus refused the duplicate check, sending anyway: {e}")
+                    existing = set()
+                except (httpx.RequestError, ValueError) as e:
+                    print(f"Could not check Directus for delivered records: {e}")
+                    return RETRY
+                duplicates = [record["id"] for record in records if record["key"] in existing]
+                self._settle(duplicates, "duplicates", self.spool.remove)
+                records = [record for record in records if record["key"] not in existing]
+                if not records:
+                    return SENT
+            items = [{**record["item"], self.key_field: record["key"]} for record in records]
+        elif operation == CREATE:
+            replayed = sum(1 for record in records if record["attempts"] > 0)
+            if replayed:
+                # Without a key field there is no way to tell whether an earlier attempt was stored
+                print(f"WARNING: replaying {replayed} Directus creates without a key_field, they may be duplicated")
+                self._count("unchecked_replays", replayed)
+            items = [record["item"] for record in records]
+        else:
+            items = [record["item"] for record in records]
+        outcome = self._send(method, items)
+        ids = [record["id"] for record in records]
+        if outcome == SENT:
+            self._settle(ids, "sent", self.spool.remove)
+        elif outcome == REJECTED:
+            self._settle(ids, "rejected", self.spool.reject)
+        return outcome
+
+    def _settle(self, ids, counter, action):
+        action(ids)
+        with self._lock:
+            self._pending -= len(ids)
+            self._counters[counter] += len(ids)
+
+    # Send one batch of spooled records: creates as one bulk POST, updates as one bulk PATCH.
+    # Returns False if anything has to be retried.
+    def flush_batch(self, records):
+        started = time.monotonic()
+        self.spool.mark_attempted([record["id"] for record in records])
+        delivered = True
+        for operation, method in ((CREATE, "POST"), (UPDATE, "PATCH")):
+            selected = [record for record in records if record["operation"] == operation]
+            if selected and self._deliver(operation, method, selected) == RETRY:
+                delivered = False
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._counters["flushes"] += 1
+            self._counters["flush_seconds"] += elapsed
+            self._counters["last_flush_seconds"] = elapsed
+        return delivered
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            # Other processes sharing the spool deliver records too; resync the depth
+            pending = self.spool.counts()["pending"]
+            with self._lock:
+                self._pending = pending
+            while not self._stopping.is_set():
+                records = self.spool.claim(self.max_batch)
+                if not records:
+                    break
+                if self.flush_batch(records):
+                    self._failures = 0
+                    continue
+                # Leave the records spooled and back off before the next replay
+                delay = min(DEFAULT_MAX_BACKOFF, self.backoff * 2 ** self._failures)
+                self._failures += 1
+                self._count("retries")
+                self._stopping.wait(random.uniform(delay / 2, delay))
+
+    # Stop the replay worker; anything still pending stays in the spool for the next start
+    def close(self, timeout=10.0):
+        self._stopping.set()
+        self._wakeup.set()
+        self._worker.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["queue_depth"] = self._pending
+        counters["mean_flush_seconds"] = counters["flush_seconds"] / counters["flushes"] if counters["flushes"] else 0.0
+        return counters
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def _close_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(_close_writers)
+
+
+# Function to get the process-wide log writer for one Directus collection (shared by all Streamlit sessions)
+def get_directus_log_writer(client, collection_url, params=None, **options):
+    with _writers_lock:
+        if collection_url not in _writers:
+            _writers[collection_url] = DirectusLogWriter(client, collection_url, params, **options)
+        return _writers[collection_url]
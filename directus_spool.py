@@ -0,0 +1,122 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_SPOOL_PATH = os.path.join(".cache", "directus_spool.sqlite3")
+DEFAULT_LEASE_SECONDS = 120.0
+
+PENDING = "pending"
+REJECTED = "rejected"
+
+
+class DirectusSpool:
+    # Durable local spool for records bound for Directus. Every record is appended to a
+    # SQLite file (WAL, synchronous=NORMAL, so an append is one cheap local commit) before
+    # the caller is acknowledged. Records stay until the replay worker has delivered them,
+    # so nothing is lost across restarts or CMS outages. Each record has an idempotency key;
+    # appending the same key twice is a no-op. Several processes may share one file: claim()
+    # leases records to one owner, and another process only takes them over once the lease
+    # has expired (the owner crashed or hung).
+    def __init__(self, path=DEFAULT_SPOOL_PATH, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT NOT NULL UNIQUE, "
+            "operation TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, "
+            "owner TEXT, lease_until REAL)"
+        )
+        # Spools written before leases existed get the columns added
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(records)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE records ADD COLUMN {column} {kind}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS records_status ON records (status, id)")
+        self._db.commit()
+
+    # Append a record; returns (idempotency key, whether a new row was stored)
+    def append(self, operation, item, key=None):
+        key = key or uuid.uuid4().hex
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO records (idempotency_key, operation, payload, status, created) VALUES (?, ?, ?, ?, ?)",
+                (key, operation, json.dumps(item, ensure_ascii=False), PENDING, time.time()),
+            )
+            self._db.commit()
+        return key, cursor.rowcount == 1
+
+    # Lease the oldest pending records that no other process holds; returns dicts with id,
+    # key, operation, item and attempts. Our own leases are renewed.
+    def claim(self, limit):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, idempotency_key, operation, payload, attempts FROM records "
+                    "WHERE status = ? AND (owner IS NULL OR owner = ? OR lease_until < ?) ORDER BY id LIMIT ?",
+                    (PENDING, self.owner, now, limit),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE records SET owner = ?, lease_until = ? WHERE id = ?",
+                    [(self.owner, now + self.lease_seconds, row[0]) for row in rows],
+                )
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        return [
+            {"id": row[0], "key": row[1], "operation": row[2], "item": json.loads(row[3]), "attempts": row[4]}
+            for row in rows
+        ]
+
+    def _update(self, sql, ids):
+        if not ids:
+            return
+        with self._lock:
+            self._db.executemany(sql, [(record_id,) for record_id in ids])
+            self._db.commit()
+
+    # Count a delivery attempt before sending, so a crash mid-send is known to need a duplicate check
+    def mark_attempted(self, ids):
+        self._update("UPDATE records SET attempts = attempts + 1 WHERE id = ?", ids)
+
+    # Remove delivered records
+    def remove(self, ids):
+        self._update("DELETE FROM records WHERE id = ?", ids)
+
+    # Keep records Directus refused (4xx) out of the replay loop without deleting them
+    def reject(self, ids):
+        self._update(f"UPDATE records SET status = '{REJECTED}' WHERE id = ?", ids)
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM records GROUP BY status").fetchall()
+        counts = {PENDING: 0, REJECTED: 0}
+        counts.update(dict(rows))
+        return counts
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+# Function to get the process-wide spool for one file (shared by all Streamlit sessions)
+def get_directus_spool(path=DEFAULT_SPOOL_PATH):
+    with _spools_lock:
+        if path not in _spools:
+            _spools[path] = DirectusSpool(path)
+        return _spools[path]
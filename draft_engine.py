@@ -0,0 +1,403 @@
+import asyncio
+import json
+import queue
+import threading
+from dataclasses import dataclass, field
+
+from context_compaction import DEFAULT_KEEP_LAST_TURNS, DEFAULT_TOKEN_CEILING, compact_messages
+from letter_stream import CHAT, LETTER, LETTER_END, LETTER_START, LetterStreamParser, parse_segments
+from rate_limiter import CHAT as CHAT_ENDPOINT, DEFAULT_COMPLETION_RESERVE, call_with_limits_async, estimate_tokens, get_rate_limiter
+from result_store import materialize_messages, tool_result_message
+from speculative_search import DEFAULT_MIN_OVERLAP, DEFAULT_REUSE_POLICY, SpeculativeSearch
+from tool_calls import ToolCallAccumulator, assistant_tool_calls_message, parse_arguments, start_task
+
+# Headless draft generation: retrieve -> pack -> generate -> parse -> log, as an asyncio
+# generator of typed events. Streamlit pages, the HTTP service and batch jobs consume the
+# same engine; the shared event loop below lets synchronous callers iterate its events.
+
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "Du är en hjälpsam assistent som hjälper en kommunanställd att författa ett svar till en invånare. Givet invånarfrågan, sammanställ relevant fakta på ett lättläst sätt, samt ge ett utkast på hur ett svar skulle kunna se ut. Ditt svar riktas till en anställd på kommunen och ska utgöra ett stöd för den anställde att återkoppla direkt till den som ställer frågan. Om du har rätt fakta för att ge ett korrekt svar, skriv det. Om inte, skriv att kommunen har tagit emot synpunkten och diariefört den men att det inte är säkert att det finns resurser att prioritera just denna fråga. Inkludera alltid källor. Svara vänligt men kortfattat. Svaret börjar med: 'Hej Namn,' och avslutas med: 'Med vänliga hälsningar, [Namn], [Avdelning på kommunen]'. Svaret ska formateras i markdown och markeras inom tags <letter>[letter content in markdown]</letter>, efter closing tag lista länk till källorna som du har baserat ditt svar på. Svaret ska aldrig hänvisa tillbaka till en specifik person, hänvisa om nödvändigt till kontaktcenter  Tel: 0346-88 60 00 Mejl: kontaktcenter@falkenberg.se. När du är ombedd kan du samla in feedback från användaren. Bekräfta för användaren om du har skickat in feedback."
+}
+
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_qdrant",
+            "description": "Search the falkenbergs kommuns databses/collections for policies and procedures. Use this when you need to find additional information to support the case worker.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "user_input": {
+                        "type": "string",
+                        "description": "Full context of the entire case including all possible keywords. 5 to 20 words of context",
+                        "example": "lekplats grönområde farligt barnlek trafikfara skötsel vägmärkesförordningen farthinder"
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "The number of similar results to return.",
+                        "default": 3
+                    }
+                },
+                "required": ["user_input"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "submit_feedback",
+            "description": "Submit user feedback to the CMS. Om du inte har tillräckligt information - fråga vilken feedback de vill lämna. Ranking 1-5.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "user_rating": {
+                        "type": "integer",
+                        "description": "User rating (1-5 stars)",
+                        "enum": [1,2,3,4,5]
+                    },
+                    "user_feedback": {
+                        "type": "string",
+                        "description": "User's textual feedback"
+                    }
+                },
+                "required": ["user_rating", "user_feedback"]
+            }
+        }
+    }
+]
+
+
+@dataclass
+class TokenEvent:
+    # Reply text outside the letter (chat channel)
+    text: str
+
+
+@dataclass
+class LetterStartEvent:
+    pass
+
+
+@dataclass
+class LetterTokenEvent:
+    # Text inside <letter>...</letter>
+    text: str
+
+
+@dataclass
+class LetterEndEvent:
+    pass
+
+
+@dataclass
+class ToolStartEvent:
+    call_id: str
+    name: str
+    arguments: dict
+
+
+@dataclass
+class ToolResultEvent:
+    call_id: str
+    name: str
+    # History message answering the call (results kept out of band by handle)
+    message: dict
+    # Search errors keyed by collection name or "embedding"
+    errors: dict = field(default_factory=dict)
+
+
+@dataclass
+class DoneEvent:
+    response: str
+    letters: list
+    # Messages to append to the conversation: tool calls, tool results and the reply
+    messages: list
+    usage: dict
+
+
+@dataclass
+class EngineConfig:
+    model: str = "gpt-4o"
+    temperature: float = 0.2
+    max_tool_rounds: int = 2
+    retrieval_first: bool = False
+    speculative_retrieval: bool = False
+    reuse_policy: str = DEFAULT_REUSE_POLICY
+    min_overlap: float = DEFAULT_MIN_OVERLAP
+    token_ceiling: int = DEFAULT_TOKEN_CEILING
+    keep_last_turns: int = DEFAULT_KEEP_LAST_TURNS
+    log_interactions: bool = False
+
+
+# Function to run a blocking function on the shared tool executor and await it
+async def in_thread(function, *args):
+    return await asyncio.wrap_future(start_task(lambda: function(*args)))
+
+
+class DraftEngine:
+    # Generates one reply to a conversation that ends with a user message. Tool calls start
+    # as soon as their arguments have streamed in, optionally after a retrieval-first search
+    # or alongside a speculative one, and a round's search results share the context budget.
+    # The reply is split into chat and letter tokens as it streams. The engine holds no
+    # per-session state; callers keep the history and the compaction state and append
+    # DoneEvent.messages themselves.
+    def __init__(self, openai_client, retriever, config=None, system_message=SYSTEM_MESSAGE, tools=TOOLS, summarize=None, log_writer=None):
+        self.openai_client = openai_client
+        self.retriever = retriever
+        self.config = config or EngineConfig()
+        self.system_message = system_message
+        self.tools = tools
+        self.summarize = summarize
+        self.log_writer = log_writer
+
+    def _prompt(self, messages, state):
+        if self.summarize is None:
+            return [self.system_message] + materialize_messages(messages)
+        return compact_messages(
+            self.system_message,
+            messages,
+            state,
+            self.summarize,
+            token_ceiling=self.config.token_ceiling,
+            keep_last_turns=self.config.keep_last_turns,
+            model=self.config.model,
+        )
+
+    def _submit_feedback(self, messages, function_args):
+        if self.log_writer is None:
+            return {"success": False, "error": "Feedback logging is not configured"}
+        chat_history = "\n".join([
+            f"{m['role']}: {m['content']}"
+            for m in messages
+            if m['role'] in ('user', 'assistant') and m.get('content')
+        ])
+        data = {
+            "prompt": chat_history,
+            "user_rating": function_args.get('user_rating'),
+            "user_feedback": function_args.get('user_feedback'),
+        }
+        return {"success": self.log_writer.create(data) is not None}
+
+    def _run_tool(self, call, function_args, messages):
+        if call["name"] == "submit_feedback":
+            return self._submit_feedback(messages, function_args)
+        return {"error": f"Unknown tool {call['name']}"}
+
+    # Start one complete arguments object of a tool call as soon as it has streamed in. A
+    # search the speculation's reuse policy accepts is answered by the speculative search.
+    def _dispatch(self, call, function_args, started, messages, speculation):
+        pending = started.setdefault(call["id"], [])
+        # Only search_qdrant accepts several concatenated argument objects
+        if pending and call["name"] != "search_qdrant":
+            return
+        if call["name"] == "search_qdrant":
+            prefetched = None
+            if speculation is not None:
+                prefetched = speculation.claim(function_args.get('user_input', ''), function_args.get('limit', 3))
+            if prefetched is None:
+                prefetched = start_task(lambda: self.retriever.search_batch([function_args]))
+            pending.append(asyncio.wrap_future(prefetched))
+            return
+        pending.append(asyncio.wrap_future(start_task(lambda: self._run_tool(call, function_args, messages))))
+
+    # Await every search of a round. Each ran with the whole context budget as soon as its
+    # arguments arrived, so its results are re-packed into the share of the budget split
+    # across all of the round's searches. Returns {call_id: [(results_per_query, errors)]}.
+    async def _search_round(self, calls, started):
+        searches = [
+            (call["id"], search)
+            for call in calls if call["name"] == "search_qdrant"
+            for search in started.get(call["id"], [])
+        ]
+        share = max(1, len(searches))
+        outputs = {}
+        for call_id, search in searches:
+            results_per_query, errors = await search
+            output = ([self.retriever.fit(results, share) for results in results_per_query], errors)
+            outputs.setdefault(call_id, []).append(output)
+        return outputs
+
+    async def _finish_call(self, call, pending, search_outputs):
+        if call["name"] != "search_qdrant":
+            output = await pending[0]
+            message = {"role": "tool", "tool_call_id": call["id"], "name": call["name"], "content": json.dumps(output)}
+            return message, {}
+        combined_results = []
+        errors = {}
+        for results_per_query, search_errors in search_outputs.get(call["id"], []):
+            combined_results += [hit for results in results_per_query for hit in results]
+            errors.update(search_errors)
+        return tool_result_message("search_qdrant", combined_results, tool_call_id=call["id"]), errors
+
+    def _letter_events(self, parsed, letters):
+        events = []
+        for channel, text in parsed:
+            if channel == CHAT:
+                events.append(TokenEvent(text))
+            elif channel == LETTER:
+                letters[-1] += text
+                events.append(LetterTokenEvent(text))
+            elif channel == LETTER_START:
+                letters.append("")
+                events.append(LetterStartEvent())
+            elif channel == LETTER_END:
+                events.append(LetterEndEvent())
+        return events
+
+    # Async generator of events for the reply to messages (which must end with the user message).
+    # state is the caller's per-conversation compaction state; session identifies the caller
+    # so the shared rate limiter can serve sessions fairly.
+    async def run(self, messages, state=None, session=None):
+        state = {} if state is None else state
+        user_input = messages[-1]["content"]
+        history = list(messages)
+        new_messages = []
+
+        def add(message):
+            history.append(message)
+            new_messages.append(message)
+
+        # The first turn of a conversation retrieves before the model is called in retrieval-first mode
+        first_pass = self.config.retrieval_first and not any(m["role"] == "user" for m in messages[:-1])
+        tools = self.tools
+        speculation = None
+        if first_pass:
+            call = {
+                "id": f"call_retrieve_{len(messages)}",
+                "name": "search_qdrant",
+                "arguments": json.dumps({"user_input": user_input}, ensure_ascii=False),
+            }
+            yield ToolStartEvent(call["id"], call["name"], {"user_input": user_input})
+            results, errors = await in_thread(self.retriever.search, user_input)
+            add(assistant_tool_calls_message([call]))
+            add(tool_result_message("search_qdrant", results, tool_call_id=call["id"]))
+            yield ToolResultEvent(call["id"], call["name"], new_messages[-1], errors)
+            # The first turn may only collect feedback; follow-up turns get every tool
+            tools = [tool for tool in self.tools if tool["function"]["name"] == "submit_feedback"]
+        elif self.config.speculative_retrieval:
+            # Search for the raw user input while the first completion is requested
+            speculation = SpeculativeSearch(
+                user_input,
+                lambda text, limit: self.retriever.search_batch([{"user_input": text, "limit": limit}]),
+                start_task,
+                policy=self.config.reuse_policy,
+                min_overlap=self.config.min_overlap,
+            )
+
+        full_response = ""
+        letters = []
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        letter_parser = LetterStreamParser()
+        try:
+            for tool_round in range(self.config.max_tool_rounds + 1):
+                prompt = await in_thread(self._prompt, history, state)
+                completion = await call_with_limits_async(
+                    get_rate_limiter(CHAT_ENDPOINT, self.config.model),
+                    lambda: self.openai_client.chat.completions.create(
+                        model=self.config.model,
+                        messages=prompt,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        tools=tools,
+                        temperature=self.config.temperature,
+                        tool_choice="auto" if tool_round < self.config.max_tool_rounds else "none",
+                    ),
+                    estimate_tokens(json.dumps(prompt, ensure_ascii=False)) + DEFAULT_COMPLETION_RESERVE,
+                    session=session,
+                )
+                tool_calls = ToolCallAccumulator()
+                started = {}
+
+                # Each tool call starts as soon as its arguments are complete, while the rest of the reply streams
+                async for chunk in completion:
+                    if chunk.usage:
+                        for key in usage:
+                            usage[key] += getattr(chunk.usage, key, 0) or 0
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.tool_calls:
+                        for call, function_args in tool_calls.add(delta.tool_calls):
+                            if call["id"] not in started:
+                                yield ToolStartEvent(call["id"], call["name"], function_args)
+                            self._dispatch(call, function_args, started, history, speculation)
+                    if delta.content:
+                        full_response += delta.content
+                        for event in self._letter_events(letter_parser.feed(delta.content), letters):
+                            yield event
+
+                # Without tool calls the reply is complete
+                if not tool_calls.calls:
+                    break
+
+                # Calls whose arguments never parsed incrementally start from the full buffer
+                for call in tool_calls.calls:
+                    if not started.get(call["id"]):
+                        for function_args in parse_arguments(call["arguments"]):
+                            if not started.get(call["id"]):
+                                yield ToolStartEvent(call["id"], call["name"], function_args)
+                            self._dispatch(call, function_args, started, history, speculation)
+
+                add(tool_calls.assistant_message())
+                search_outputs = await self._search_round(tool_calls.calls, started)
+                for call in tool_calls.calls:
+                    message, errors = await self._finish_call(call, started[call["id"]], search_outputs)
+                    add(message)
+                    yield ToolResultEvent(call["id"], call["name"], message, errors)
+        finally:
+            if speculation is not None:
+                speculation.finish()
+
+        for event in self._letter_events(letter_parser.finish(), letters):
+            yield event
+        add({"role": "assistant", "content": full_response, "segments": parse_segments(full_response)})
+        if self.config.log_interactions and self.log_writer is not None:
+            await in_thread(self.log_writer.create, {"prompt": user_input, "response": full_response})
+        yield DoneEvent(full_response, letters, new_messages, usage)
+
+
+_loop = None
+_loop_lock = threading.Lock()
+_END = object()
+
+
+# Function to get the process-wide engine event loop, running on its own daemon thread
+def get_engine_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="draft-engine", daemon=True).start()
+        return _loop
+
+
+# Function to iterate an engine event generator from synchronous code (e.g. a Streamlit script).
+# The generator runs on the shared engine loop; errors are re-raised in the caller.
+def iterate_events(events, loop=None):
+    loop = loop or get_engine_loop()
+    received = queue.Queue()
+
+    async def pump():
+        try:
+            async for event in events:
+                received.put(event)
+        except Exception as e:
+            received.put(e)
+        finally:
+            received.put(_END)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    try:
+        while True:
+            item = received.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop generating if the caller stops early, e.g. on a Streamlit rerun
+        future.cancel()
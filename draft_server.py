@@ -0,0 +1,136 @@
+import argparse
+import json
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from clients import client_metrics
+from draft_engine import (
+    DoneEvent,
+    LetterEndEvent,
+    LetterStartEvent,
+    LetterTokenEvent,
+    TokenEvent,
+    ToolResultEvent,
+    ToolStartEvent,
+)
+from engine_factory import build_engine
+from qdrant_search import payload_metrics
+from rate_limiter import rate_limit_metrics
+from speculative_search import get_speculation_stats
+
+# Draft generator as an HTTP service: POST /drafts streams Server-Sent Events with separate
+# "chat" and "letter" events, so other systems can request drafts without the Streamlit UI.
+# Every request runs on the server's event loop, so one worker serves many concurrent streams.
+#
+#   uvicorn draft_server:app --host 0.0.0.0 --port 8000 --workers 2
+#
+# Configuration comes from the environment, see engine_factory.py. For load tests, point
+# OPENAI_BASE_URL at stub_openai.py, set OPENAI_API_KEY=stub and QDRANT_URL=:memory:, and
+# raise the chat limits so the limiter does not throttle the stub, e.g.
+#
+#   CHAT_RPM=100000 CHAT_TPM=100000000 uvicorn draft_server:app
+
+
+# Function to format one Server-Sent Event
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Function to turn engine events into Server-Sent Events
+async def stream_events(engine, messages, session=None):
+    try:
+        async for event in engine.run(messages, session=session):
+            if isinstance(event, TokenEvent):
+                yield sse("chat", {"text": event.text})
+            elif isinstance(event, LetterTokenEvent):
+                yield sse("letter", {"text": event.text})
+            elif isinstance(event, LetterStartEvent):
+                yield sse("letter_start", {})
+            elif isinstance(event, LetterEndEvent):
+                yield sse("letter_end", {})
+            elif isinstance(event, ToolStartEvent):
+                yield sse("tool_start", {"id": event.call_id, "name": event.name, "arguments": event.arguments})
+            elif isinstance(event, ToolResultEvent):
+                yield sse("tool_result", {"id": event.call_id, "name": event.name, "summary": event.message["content"], "errors": event.errors})
+            elif isinstance(event, DoneEvent):
+                # Segments are for rendering and result handles only mean something inside this process
+                messages = [{key: value for key, value in m.items() if key not in ("segments", "result_handle")} for m in event.messages]
+                yield sse("done", {"response": event.response, "letters": event.letters, "messages": messages, "usage": event.usage})
+    except Exception as e:
+        print(f"Draft generation failed: {e}")
+        yield sse("error", {"message": str(e)})
+
+
+# Function to identify the caller for fair rate limiting: an X-Session-Id header, else the client address
+def session_key(request):
+    return request.headers.get("x-session-id") or (request.client.host if request.client else None)
+
+
+# Function to check client messages: only user and assistant turns with text, ending with the
+# user message. Returns the messages reduced to role and content, or None if they are invalid.
+def client_messages(messages):
+    if not isinstance(messages, list) or not messages:
+        return None
+    cleaned = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in ("user", "assistant"):
+            return None
+        if not isinstance(message.get("content"), str):
+            return None
+        cleaned.append({"role": message["role"], "content": message["content"]})
+    if cleaned[-1]["role"] != "user" or not cleaned[-1]["content"].strip():
+        return None
+    return cleaned
+
+
+# POST /drafts with {"messages": [...]} (user and assistant turns ending with the user message) or {"inquiry": "..."}
+async def drafts(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Body must be JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "Body must be a JSON object"}, status_code=400)
+    inquiry = body.get("inquiry")
+    messages = client_messages(body.get("messages") if "messages" in body else [{"role": "user", "content": inquiry}])
+    if messages is None:
+        return JSONResponse({"error": "Send an inquiry or user/assistant messages with text content, ending with a user message"}, status_code=400)
+    return StreamingResponse(
+        stream_events(request.app.state.engine, messages, session_key(request)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def health(request):
+    engine = request.app.state.engine
+    return JSONResponse({
+        "status": "ok",
+        "clients": client_metrics(),
+        "embeddings": engine.retriever.embedding_backend.stats(),
+        "payload": payload_metrics(),
+        "rate_limits": rate_limit_metrics(),
+        "sparse": engine.retriever.sparse_index.stats() if engine.retriever.sparse_index is not None else None,
+        "speculation": get_speculation_stats().stats(),
+    })
+
+
+app = Starlette(routes=[Route("/drafts", drafts, methods=["POST"]), Route("/health", health)])
+app.state.engine = build_engine()
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the draft generator over Server-Sent Events")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    uvicorn.run("draft_server:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
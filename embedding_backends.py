@@ -0,0 +1,123 @@
+import re
+import threading
+
+from embedding_cache import DEFAULT_CACHE_PATH, get_embedding_cache, normalize_text
+from embedding_service import DEFAULT_BATCH_WINDOW, get_embedding_batcher, openai_embed_many
+
+DEFAULT_OPENAI_MODEL = "text-embedding-3-large"
+DEFAULT_LOCAL_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+# Function to turn a model name into a collection-name-safe suffix
+def model_slug(model):
+    return re.sub(r"[^A-Za-z0-9]+", "_", model.split("/")[-1]).strip("_").lower()
+
+
+class OpenAIEmbeddingBackend:
+    # Remote embeddings through the shared cache + micro-batcher; searches the original collections
+    name = "openai"
+
+    def __init__(self, openai_client, model=DEFAULT_OPENAI_MODEL, cache=None, window=DEFAULT_BATCH_WINDOW):
+        self.model = model
+        self.batcher = get_embedding_batcher(model, openai_embed_many(openai_client, model), cache=cache, window=window)
+
+    def collection_name(self, base_name):
+        return base_name
+
+    def embed(self, text):
+        return self.batcher.embed(text)
+
+    def embed_many(self, texts):
+        return self.batcher.embed_many(texts)
+
+    def stats(self):
+        return self.batcher.stats()
+
+
+_local_models = {}
+_local_models_lock = threading.Lock()
+
+
+# Function to load a sentence-transformers model once per process, optionally int8-quantized
+def load_local_model(model_name, quantize=True, device="cpu"):
+    key = (model_name, quantize, device)
+    with _local_models_lock:
+        model = _local_models.get(key)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name, device=device)
+            if quantize and device == "cpu":
+                import torch
+
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            model.eval()
+            _local_models[key] = model
+        return model
+
+
+class LocalEmbeddingBackend:
+    # In-process CPU embeddings; searches mirrored collections built with the same model
+    name = "local"
+
+    def __init__(self, model=DEFAULT_LOCAL_MODEL, cache=None, quantize=True, device="cpu", query_prefix=""):
+        self.model = model
+        self.cache = cache
+        self.quantize = quantize
+        self.device = device
+        self.query_prefix = query_prefix
+        self.collection_suffix = f"__{model_slug(model)}"
+
+    def collection_name(self, base_name):
+        return base_name + self.collection_suffix
+
+    def encode(self, texts, prefix=""):
+        model = load_local_model(self.model, self.quantize, self.device)
+        vectors = model.encode(
+            [prefix + normalize_text(text) for text in texts],
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return vectors.tolist()
+
+    def embed(self, text):
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts):
+        results = [None] * len(texts)
+        missing = []
+        for position, text in enumerate(texts):
+            vector = self.cache.get(text, self.model) if self.cache is not None else None
+            if vector is None:
+                missing.append(position)
+            else:
+                results[position] = vector
+        if missing:
+            vectors = self.encode([texts[position] for position in missing], self.query_prefix)
+            for position, vector in zip(missing, vectors):
+                results[position] = vector
+                if self.cache is not None:
+                    self.cache.put(texts[position], self.model, vector)
+        return results
+
+    def stats(self):
+        return self.cache.stats() if self.cache is not None else {}
+
+
+# Function to build the configured embedding backend ("openai" or "local")
+def get_embedding_backend(
+    backend="openai",
+    openai_client=None,
+    openai_model=DEFAULT_OPENAI_MODEL,
+    local_model=DEFAULT_LOCAL_MODEL,
+    cache_path=DEFAULT_CACHE_PATH,
+    batch_window=DEFAULT_BATCH_WINDOW,
+    quantize=True,
+):
+    cache = get_embedding_cache(cache_path)
+    if backend == "local":
+        return LocalEmbeddingBackend(local_model, cache=cache, quantize=quantize)
+    if backend == "openai":
+        return OpenAIEmbeddingBackend(openai_client, openai_model, cache=cache, window=batch_window)
+    raise ValueError(f"Unknown embedding backend: {backend}")
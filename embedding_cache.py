@@ -0,0 +1,124 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "embeddings.sqlite3")
+DEFAULT_MEMORY_ITEMS = 2048
+
+
+# Function to normalize text so trivially different inputs share one cache entry
+def normalize_text(text):
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.split())
+
+
+# Function to build the cache key from normalized text and model name
+def cache_key(text, model):
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    # Two tiers: an in-memory LRU in front of a SQLite file that survives restarts
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_memory_items=DEFAULT_MEMORY_ITEMS):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "miss_seconds": 0.0,
+        }
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, text, model):
+        key = cache_key(text, model)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return vector
+            if self._db is not None:
+                row = self._db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    vector = array("f", row[0]).tolist()
+                    self._remember(key, vector)
+                    self._counters["disk_hits"] += 1
+                    return vector
+        return None
+
+    def put(self, text, model, vector):
+        key = cache_key(text, model)
+        with self._lock:
+            self._remember(key, vector)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, created) VALUES (?, ?, ?, ?)",
+                    (key, model, array("f", vector).tobytes(), time.time()),
+                )
+                self._db.commit()
+
+    # Count a lookup that had to go to the embedding backend and how long that took
+    def record_miss(self, seconds, count=1):
+        with self._lock:
+            self._counters["misses"] += count
+            self._counters["miss_seconds"] += seconds * count
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            memory_items = len(self._memory)
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+        average_miss = counters["miss_seconds"] / counters["misses"] if counters["misses"] else 0.0
+        return {
+            "memory_hits": counters["memory_hits"],
+            "disk_hits": counters["disk_hits"],
+            "misses": counters["misses"],
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_items": memory_items,
+            "average_miss_seconds": average_miss,
+            "estimated_seconds_saved": hits * average_miss,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Function to get the process-wide cache for a path (shared by all Streamlit sessions)
+def get_embedding_cache(path=DEFAULT_CACHE_PATH, max_memory_items=DEFAULT_MEMORY_ITEMS):
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = EmbeddingCache(path, max_memory_items)
+            _caches[path] = cache
+        return cache
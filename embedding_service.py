@@ -0,0 +1,155 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from embedding_cache import cache_key, normalize_text
+from rate_limiter import EMBEDDINGS, call_with_limits, estimate_tokens, get_rate_limiter
+
+DEFAULT_BATCH_WINDOW = 0.02
+DEFAULT_MAX_BATCH = 64
+
+
+# Function to embed a list of texts with one OpenAI request, keeping input order
+def openai_embed_many(openai_client, model):
+    def embed_many(texts):
+        response = call_with_limits(
+            get_rate_limiter(EMBEDDINGS, model),
+            lambda: openai_client.embeddings.create(input=texts, model=model),
+            sum(estimate_tokens(text) for text in texts),
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    return embed_many
+
+
+class EmbeddingBatcher:
+    # Collects concurrent embed() calls from all sessions for a short window and sends
+    # them as one batched request. Identical texts already in flight share one future.
+    def __init__(self, embed_many, model, cache=None, window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.embed_many_fn = embed_many
+        self.model = model
+        self.cache = cache
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._in_flight = {}
+        self._condition = threading.Condition()
+        self._worker = None
+        self._counters = {
+            "requests": 0,
+            "cache_hits": 0,
+            "deduplicated": 0,
+            "batches": 0,
+            "batched_texts": 0,
+            "errors": 0,
+        }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name=f"embedding-batcher-{self.model}", daemon=True)
+            self._worker.start()
+
+    # Queue a text and return a future resolving to its vector
+    def submit(self, text):
+        text = normalize_text(text)
+        future = Future()
+        if self.cache is not None:
+            vector = self.cache.get(text, self.model)
+            if vector is not None:
+                with self._condition:
+                    self._counters["requests"] += 1
+                    self._counters["cache_hits"] += 1
+                future.set_result(vector)
+                return future
+        key = cache_key(text, self.model)
+        with self._condition:
+            self._counters["requests"] += 1
+            existing = self._in_flight.get(key)
+            if existing is not None:
+                self._counters["deduplicated"] += 1
+                return existing
+            self._in_flight[key] = future
+            self._pending.append((key, text, future))
+            self._ensure_worker()
+            self._condition.notify()
+        return future
+
+    def embed(self, text, timeout=None):
+        return self.submit(text).result(timeout)
+
+    # Embed several texts; they are queued together so they normally land in one batch
+    def embed_many(self, texts, timeout=None):
+        futures = [self.submit(text) for text in texts]
+        return [future.result(timeout) for future in futures]
+
+    def _take_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _embed_batch(self, batch):
+        texts = [text for _, text, _ in batch]
+        started = time.perf_counter()
+        vectors = self.embed_many_fn(texts)
+        if len(vectors) != len(batch):
+            raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+        elapsed = time.perf_counter() - started
+        for (_, _, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+        with self._condition:
+            self._counters["batches"] += 1
+            self._counters["batched_texts"] += len(batch)
+        if self.cache is not None:
+            self.cache.record_miss(elapsed, len(batch))
+            for text, vector in zip(texts, vectors):
+                self.cache.put(text, self.model, vector)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._embed_batch(batch)
+            except Exception as e:
+                print(f"Embedding batch failed: {e}")
+                with self._condition:
+                    self._counters["errors"] += 1
+                # Callers wait without a timeout, so every unresolved future must fail
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    for key, _, _ in batch:
+                        self._in_flight.pop(key, None)
+
+    def stats(self):
+        with self._condition:
+            counters = dict(self._counters)
+            counters["pending"] = len(self._pending)
+            counters["in_flight"] = len(self._in_flight)
+        counters["average_batch_size"] = (
+            counters["batched_texts"] / counters["batches"] if counters["batches"] else 0.0
+        )
+        return counters
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+# Function to get the process-wide batcher for a model (shared by all Streamlit sessions)
+def get_embedding_batcher(model, embed_many, cache=None, window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+    with _batchers_lock:
+        batcher = _batchers.get(model)
+        if batcher is None:
+            batcher = EmbeddingBatcher(embed_many, model, cache, window, max_batch)
+            _batchers[model] = batcher
+        return batcher
@@ -0,0 +1,116 @@
+import os
+import random
+
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from qdrant_client.models import Distance, PointStruct, VectorParams
+
+from clients import get_async_openai_client, get_directus_client, get_openai_client, get_qdrant_client
+from directus_log import DEFAULT_KEY_FIELD, get_directus_log_writer
+from draft_engine import DraftEngine, EngineConfig
+from embedding_backends import DEFAULT_OPENAI_MODEL, get_embedding_backend
+from embedding_cache import DEFAULT_CACHE_PATH
+from rate_limiter import CHAT, EMBEDDINGS, get_rate_limiter
+from retrieval import DEFAULT_COLLECTIONS, Retriever
+from semantic_cache import get_semantic_result_cache
+from sparse_index import get_sparse_index
+
+# Builds a DraftEngine for processes outside Streamlit (the HTTP service and batch jobs).
+# Configuration comes from the environment (.env): OPENAI_API_KEY and QDRANT_URL (required),
+# OPENAI_BASE_URL, QDRANT_API_KEY, SEARCH_COLLECTIONS, EMBEDDING_BACKEND, GPT_MODEL, RETRIEVAL_FIRST,
+# SPECULATIVE_RETRIEVAL, HYBRID_SEARCH (on unless 0), CHAT_RPM, CHAT_TPM, EMBEDDING_RPM,
+# EMBEDDING_TPM and optionally DIRECTUS_TOKEN and DIRECTUS_KEY_FIELD. Only an explicit QDRANT_URL=:memory: searches
+# seeded in-memory collections of random vectors, for load tests against stub_openai.py.
+
+DIRECTUS_API_URL = "https://nav.utvecklingfalkenberg.se/items/kft_bot"
+MEMORY_QDRANT = ":memory:"
+DEFAULT_MEMORY_DIMENSIONS = 256
+DEFAULT_MEMORY_POINTS = 200
+
+
+# Function to read a setting that has no safe default
+def _required_env(name):
+    value = os.environ.get(name)
+    if not value:
+        raise RuntimeError(f"{name} is not set; see engine_factory.py for the settings")
+    return value
+
+
+def _int_env(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+# Function to fill in-memory collections with random vectors and placeholder payloads
+def seed_memory_collections(qdrant_client, collections, dimensions=DEFAULT_MEMORY_DIMENSIONS, points=DEFAULT_MEMORY_POINTS):
+    generator = random.Random(0)
+    for collection_name in collections:
+        qdrant_client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=dimensions, distance=Distance.COSINE),
+        )
+        qdrant_client.upsert(
+            collection_name=collection_name,
+            points=[
+                PointStruct(
+                    id=point_id,
+                    vector=[generator.gauss(0, 1) for _ in range(dimensions)],
+                    payload={
+                        "title": f"{collection_name} {point_id}",
+                        "url": f"https://example.invalid/{collection_name}/{point_id}",
+                        "chunk": f"Exempeltext {point_id} om lekplatser, bygglov och avfallshämtning i Falkenbergs kommun.",
+                    },
+                )
+                for point_id in range(points)
+            ],
+        )
+
+
+# Function to build the engine from environment variables; keyword arguments override EngineConfig fields
+def build_engine(**config_overrides):
+    load_dotenv()
+    api_key = _required_env("OPENAI_API_KEY")
+    base_url = os.environ.get("OPENAI_BASE_URL")
+    collections = os.environ.get("SEARCH_COLLECTIONS", ",".join(DEFAULT_COLLECTIONS)).split(",")
+    openai_client = get_openai_client(api_key, base_url=base_url)
+    model = os.environ.get("GPT_MODEL", "gpt-4o")
+    get_rate_limiter(CHAT, model, rpm=_int_env("CHAT_RPM"), tpm=_int_env("CHAT_TPM"))
+    get_rate_limiter(EMBEDDINGS, DEFAULT_OPENAI_MODEL, rpm=_int_env("EMBEDDING_RPM"), tpm=_int_env("EMBEDDING_TPM"))
+
+    qdrant_url = _required_env("QDRANT_URL")
+    cache_path = os.environ.get("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH)
+    if qdrant_url == MEMORY_QDRANT:
+        qdrant_client = QdrantClient(MEMORY_QDRANT)
+        seed_memory_collections(qdrant_client, collections, int(os.environ.get("MEMORY_DIMENSIONS", DEFAULT_MEMORY_DIMENSIONS)))
+        # Keep stub embeddings out of the on-disk cache
+        cache_path = None
+    else:
+        qdrant_client = get_qdrant_client(qdrant_url, api_key=os.environ.get("QDRANT_API_KEY"))
+
+    log_writer = None
+    if os.environ.get("DIRECTUS_TOKEN"):
+        log_writer = get_directus_log_writer(
+            get_directus_client(),
+            DIRECTUS_API_URL,
+            {"access_token": os.environ["DIRECTUS_TOKEN"]},
+            key_field=os.environ.get("DIRECTUS_KEY_FIELD", DEFAULT_KEY_FIELD),
+        )
+
+    retriever = Retriever(
+        get_embedding_backend(os.environ.get("EMBEDDING_BACKEND", "openai"), openai_client=openai_client, cache_path=cache_path),
+        qdrant_client,
+        collections=collections,
+        result_cache=get_semantic_result_cache(),
+        sparse_index=get_sparse_index(qdrant_client, collections) if os.environ.get("HYBRID_SEARCH", "1") != "0" else None,
+    )
+    return DraftEngine(
+        get_async_openai_client(api_key, base_url=base_url),
+        retriever,
+        config=EngineConfig(**{
+            "model": model,
+            "retrieval_first": os.environ.get("RETRIEVAL_FIRST", "") == "1",
+            "speculative_retrieval": os.environ.get("SPECULATIVE_RETRIEVAL", "") == "1",
+            **config_overrides,
+        }),
+        log_writer=log_writer,
+    )
@@ -0,0 +1,76 @@
+LETTER_OPEN = "<letter>"
+LETTER_CLOSE = "</letter>"
+
+CHAT = "chat"
+LETTER = "letter"
+LETTER_START = "letter_start"
+LETTER_END = "letter_end"
+
+
+# Function to find how much of the end of text could be the start of tag
+def _partial_tag_length(text, tag):
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
+
+
+class LetterStreamParser:
+    # Single-pass state machine that routes streamed text to a chat channel and a letter
+    # channel. Only the new delta plus at most one partial tag is scanned per feed(), and
+    # tags split across chunk boundaries are held back until they can be decided.
+    def __init__(self):
+        self.in_letter = False
+        self._pending = ""
+
+    # Feed one delta; returns a list of (channel, text) events in order
+    def feed(self, delta):
+        events = []
+        text = self._pending + (delta or "")
+        self._pending = ""
+        position = 0
+        while position < len(text):
+            tag = LETTER_CLOSE if self.in_letter else LETTER_OPEN
+            channel = LETTER if self.in_letter else CHAT
+            index = text.find(tag, position)
+            if index == -1:
+                held = _partial_tag_length(text[position:], tag)
+                end = len(text) - held
+                if end > position:
+                    events.append((channel, text[position:end]))
+                self._pending = text[end:]
+                break
+            if index > position:
+                events.append((channel, text[position:index]))
+            self.in_letter = not self.in_letter
+            events.append((LETTER_START if self.in_letter else LETTER_END, ""))
+            position = index + len(tag)
+        return events
+
+    # Flush text held back as a possible partial tag once the stream has ended
+    def finish(self):
+        events = []
+        if self._pending:
+            events.append((LETTER if self.in_letter else CHAT, self._pending))
+            self._pending = ""
+        return events
+
+
+# Function to split a complete message into text and letter segments in one pass
+def parse_segments(content):
+    parser = LetterStreamParser()
+    segments = []
+    current = None
+    for channel, text in parser.feed(content) + parser.finish():
+        if channel in (LETTER_START, LETTER_END):
+            current = None
+            continue
+        segment_type = "letter" if channel == LETTER else "text"
+        if current is None or current["type"] != segment_type:
+            current = {"type": segment_type, "content": ""}
+            segments.append(current)
+        current["content"] += text
+    for segment in segments:
+        if segment["type"] == "text":
+            segment["content"] = segment["content"].strip()
+    return [segment for segment in segments if segment["content"]]
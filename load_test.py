@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+# Opens many concurrent /drafts streams against draft_server.py and reports time to the first
+# chat and letter events, total stream time and throughput.
+#
+#   python load_test.py --url http://127.0.0.1:8000 --concurrency 50 --requests 200
+
+DEFAULT_INQUIRY = "Lekplatsen vid skolan har trasiga gungor och bilarna kör för fort förbi. Kan kommunen åtgärda det?"
+
+
+# Function to run one draft request and time its events
+async def run_one(client, url, inquiry):
+    started = time.monotonic()
+    timings = {"first_chat": None, "first_letter": None, "total": None, "error": None, "tokens": 0}
+    event = None
+    async with client.stream("POST", f"{url}/drafts", json={"inquiry": inquiry}) as response:
+        if response.status_code != 200:
+            timings["error"] = f"HTTP {response.status_code}"
+            return timings
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                elapsed = time.monotonic() - started
+                if event == "chat" and timings["first_chat"] is None:
+                    timings["first_chat"] = elapsed
+                elif event == "letter" and timings["first_letter"] is None:
+                    timings["first_letter"] = elapsed
+                elif event == "done":
+                    timings["tokens"] = json.loads(line[len("data: "):])["usage"]["total_tokens"]
+                elif event == "error":
+                    timings["error"] = json.loads(line[len("data: "):])["message"]
+    timings["total"] = time.monotonic() - started
+    return timings
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))] if values else None
+
+
+async def run_load(url, concurrency, requests, inquiry):
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        async def bounded():
+            async with semaphore:
+                try:
+                    return await run_one(client, url, inquiry)
+                except httpx.HTTPError as e:
+                    return {"first_chat": None, "first_letter": None, "total": None, "error": str(e), "tokens": 0}
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(bounded() for _ in range(requests)))
+        elapsed = time.monotonic() - started
+
+    errors = [result["error"] for result in results if result["error"]]
+    print(f"{requests} streams, concurrency {concurrency}, {elapsed:.1f}s, {requests / elapsed:.1f} streams/s, {len(errors)} errors")
+    for key in ("first_chat", "first_letter", "total"):
+        values = [result[key] for result in results if result[key] is not None]
+        if values:
+            print(f"{key:>12}: p50 {statistics.median(values):.3f}s  p95 {percentile(values, 0.95):.3f}s  max {max(values):.3f}s")
+    print(f"tokens: {sum(result['tokens'] for result in results)}")
+    for error in sorted(set(errors))[:5]:
+        print("error:", error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the draft server's SSE endpoint")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--inquiry", default=DEFAULT_INQUIRY)
+    args = parser.parse_args()
+    asyncio.run(run_load(args.url, args.concurrency, args.requests, args.inquiry))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import os
+
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from qdrant_client.models import Distance, PointStruct, VectorParams
+
+from embedding_backends import DEFAULT_LOCAL_MODEL, LocalEmbeddingBackend
+from semantic_cache import mark_collection_changed
+
+# Builds copies of the Qdrant collections embedded with the local sentence-transformers model,
+# so the apps can run with embedding_backend = "local" and never call the embedding API.
+#
+#   python mirror_collections.py FalkenbergsKommunsHemsida mediawiki
+
+DEFAULT_COLLECTIONS = ["FalkenbergsKommunsHemsida", "FalkenbergsKommunsHemsida_1000char_chunks", "mediawiki"]
+
+
+# Function to copy one collection, re-embedding the chunk payload with the local model
+def mirror_collection(qdrant_client, backend, source_name, text_field="chunk", batch_size=128, passage_prefix=""):
+    target_name = backend.collection_name(source_name)
+    dimension = len(backend.encode(["dimension probe"])[0])
+    if qdrant_client.collection_exists(target_name):
+        qdrant_client.delete_collection(target_name)
+    qdrant_client.create_collection(
+        collection_name=target_name,
+        vectors_config=VectorParams(size=dimension, distance=Distance.COSINE),
+    )
+
+    copied = 0
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=source_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=False,
+        )
+        points = [point for point in points if point.payload and point.payload.get(text_field)]
+        if points:
+            vectors = backend.encode([point.payload[text_field] for point in points], passage_prefix)
+            qdrant_client.upsert(
+                collection_name=target_name,
+                points=[
+                    PointStruct(id=point.id, vector=vector, payload=point.payload)
+                    for point, vector in zip(points, vectors)
+                ],
+            )
+            copied += len(points)
+            print(f"{target_name}: {copied} points")
+        if offset is None:
+            break
+    mark_collection_changed(qdrant_client, target_name)
+    return target_name, copied
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Mirror Qdrant collections with a local embedding model")
+    parser.add_argument("collections", nargs="*", default=DEFAULT_COLLECTIONS)
+    parser.add_argument("--model", default=DEFAULT_LOCAL_MODEL)
+    parser.add_argument("--text-field", default="chunk")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--passage-prefix", default="")
+    parser.add_argument("--no-quantize", action="store_true")
+    args = parser.parse_args()
+
+    qdrant_client = QdrantClient(url=os.environ["QDRANT_URL"], port=443, api_key=os.environ.get("QDRANT_API_KEY"))
+    backend = LocalEmbeddingBackend(args.model, quantize=not args.no_quantize)
+    for source_name in args.collections:
+        target_name, copied = mirror_collection(
+            qdrant_client, backend, source_name, args.text_field, args.batch_size, args.passage_prefix
+        )
+        print(f"Mirrored {source_name} -> {target_name} ({copied} points)")
+
+
+if __name__ == "__main__":
+    main()
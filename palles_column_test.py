@@ -1,5 +1,9 @@
+import json
+import uuid
+
 import streamlit as st
-from openai import OpenAI
+from clients import get_openai_client
+from rate_limiter import CHAT, DEFAULT_COMPLETION_RESERVE, call_with_limits, estimate_tokens, get_rate_limiter
 import re
 
 # Set page config
@@ -12,17 +16,25 @@ if "messages" not in st.session_state:
 if "display_mode" not in st.session_state:
     st.session_state.display_mode = "chat"
 
+if "rate_limit_session" not in st.session_state:
+    st.session_state.rate_limit_session = uuid.uuid4().hex
+
 # Function to get chat response (streaming)
 def get_chat_response_streaming(user_message, instructions_prompt, model="gpt-3.5-turbo", client=None):
     if client is None:
-        client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+        client = get_openai_client(st.secrets["OPENAI_API_KEY"])
     
     messages = [
         {"role": "system", "content": instructions_prompt},
         {"role": "user", "content": user_message}
     ]
     
-    stream = client.chat.completions.create(model=model, messages=messages, stream=True)
+    stream = call_with_limits(
+        get_rate_limiter(CHAT, model),
+        lambda: client.chat.completions.create(model=model, messages=messages, stream=True),
+        estimate_tokens(json.dumps(messages, ensure_ascii=False)) + DEFAULT_COMPLETION_RESERVE,
+        session=st.session_state.rate_limit_session,
+    )
     return stream
 
 # Function to extract letter content
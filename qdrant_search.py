@@ -0,0 +1,231 @@
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from qdrant_client.models import QueryRequest
+
+DEFAULT_SEARCH_TIMEOUT = 5.0
+MAX_SEARCH_WORKERS = 16
+
+# Payload fields sent back by Qdrant per collection (matched on the collection name prefix);
+# everything else stays on the server. None means the full payload.
+DEFAULT_PAYLOAD_FIELDS = {
+    "FalkenbergsKommunsHemsida": ["title", "url", "chunk"],
+    "mediawiki": ["title", "url", "chunk"],
+}
+DEFAULT_MAX_HIT_CHARS = 1200
+
+# Shared by all sessions so concurrent searches stay bounded per process
+_search_executor = ThreadPoolExecutor(max_workers=MAX_SEARCH_WORKERS, thread_name_prefix="qdrant-search")
+
+PAYLOAD_SAMPLE_SIZE = 10
+
+_payload_lock = threading.Lock()
+_payload_counters = {"hits": 0, "payload_chars": 0, "avoided_chars": 0, "prompt_chars": 0, "truncated_hits": 0}
+# Per collection: mean JSON size of a hit's full and projected payload, sampled once
+_payload_samples = {}
+
+
+# Function to pick the payload fields for a collection (mirrored collections share their base name's fields)
+def payload_fields_for(collection_name, payload_fields=DEFAULT_PAYLOAD_FIELDS):
+    if payload_fields is None or isinstance(payload_fields, (list, tuple)):
+        return payload_fields
+    matches = [name for name in payload_fields if collection_name.startswith(name)]
+    if not matches:
+        return None
+    return payload_fields[max(matches, key=len)]
+
+
+# Function to pick the timeout for a collection; mirrored collections use their base name's override
+def timeout_for(collection_name, timeout=DEFAULT_SEARCH_TIMEOUT):
+    if not hasattr(timeout, "get"):
+        return timeout
+    if collection_name in timeout:
+        return timeout[collection_name]
+    matches = [name for name in timeout if collection_name.startswith(name)]
+    return timeout[max(matches, key=len)] if matches else DEFAULT_SEARCH_TIMEOUT
+
+
+# Function to measure, once per collection, how large the full payloads of some hits are
+# compared to their projected payloads, so payload_metrics can report what field selection saves
+def sample_payload_size(qdrant_client, collection_name, points):
+    with _payload_lock:
+        if collection_name in _payload_samples or not points:
+            return
+        _payload_samples[collection_name] = None
+    points = points[:PAYLOAD_SAMPLE_SIZE]
+    try:
+        full_points = qdrant_client.retrieve(collection_name, ids=[point.id for point in points], with_payload=True, with_vectors=False)
+    except Exception as e:
+        print(f"Could not sample full payloads of {collection_name}: {e}")
+        with _payload_lock:
+            del _payload_samples[collection_name]
+        return
+    full_chars = sum(len(json.dumps(point.payload or {}, ensure_ascii=False)) for point in full_points)
+    projected_chars = sum(len(json.dumps(point.payload or {}, ensure_ascii=False)) for point in points)
+    with _payload_lock:
+        _payload_samples[collection_name] = {
+            "full_chars": full_chars / max(1, len(full_points)),
+            "projected_chars": projected_chars / len(points),
+        }
+
+
+# Function to run every query against one collection in a single batch request (runs on the shared pool)
+def query_collection_batch(qdrant_client, collection_name, query_vectors, limits, timeout, fields=None):
+    with_payload = list(fields) if fields else True
+    responses = qdrant_client.query_batch_points(
+        collection_name=collection_name,
+        requests=[
+            QueryRequest(query=query_vector, limit=limit, with_payload=with_payload)
+            for query_vector, limit in zip(query_vectors, limits)
+        ],
+        timeout=max(1, int(timeout)),
+    )
+    points_per_query = [response.points for response in responses]
+    if fields:
+        sample_payload_size(qdrant_client, collection_name, [point for points in points_per_query for point in points])
+    return points_per_query
+
+
+# Function to answer what it can from the semantic result cache and batch-query only the misses
+def query_collection_cached(qdrant_client, collection_name, query_vectors, limits, timeout, result_cache, fields=None):
+    if result_cache is None:
+        return query_collection_batch(qdrant_client, collection_name, query_vectors, limits, timeout, fields)
+    variant = tuple(fields) if fields else None
+    points_per_query = [
+        result_cache.lookup(qdrant_client, collection_name, query_vector, limit, variant)
+        for query_vector, limit in zip(query_vectors, limits)
+    ]
+    missing = [index for index, points in enumerate(points_per_query) if points is None]
+    if missing:
+        fetched = query_collection_batch(
+            qdrant_client,
+            collection_name,
+            [query_vectors[index] for index in missing],
+            [limits[index] for index in missing],
+            timeout,
+            fields,
+        )
+        for index, points in zip(missing, fetched):
+            points_per_query[index] = points
+            result_cache.store(qdrant_client, collection_name, query_vectors[index], limits[index], points, variant)
+    return points_per_query
+
+
+# Function to search several collections concurrently with a batch of query vectors.
+# limit is one number or one per query; timeout is seconds per collection, either one
+# number or a {collection_name: seconds} mapping matched on the name prefix, so mirrored
+# collections use their base name's timeout. Returns (hits_per_query, errors) where
+# hits_per_query[i] is a list of (collection_name, point) for query i in arrival order.
+# With a result_cache, near-duplicate queries are answered without calling Qdrant.
+# payload_fields is a list of fields or a {collection_name_prefix: fields} mapping.
+def search_collections_batch(qdrant_client, collection_names, query_vectors, limit=3, timeout=DEFAULT_SEARCH_TIMEOUT, result_cache=None, payload_fields=DEFAULT_PAYLOAD_FIELDS):
+    limits = list(limit) if isinstance(limit, (list, tuple)) else [limit] * len(query_vectors)
+    hits_per_query = [[] for _ in query_vectors]
+    errors = {}
+    if not query_vectors:
+        return hits_per_query, errors
+
+    started = time.monotonic()
+    deadlines = {}
+    pending = {}
+    for collection_name in collection_names:
+        collection_timeout = timeout_for(collection_name, timeout)
+        deadlines[collection_name] = started + collection_timeout
+        future = _search_executor.submit(
+            query_collection_cached,
+            qdrant_client,
+            collection_name,
+            query_vectors,
+            limits,
+            collection_timeout,
+            result_cache,
+            payload_fields_for(collection_name, payload_fields),
+        )
+        pending[future] = collection_name
+
+    while pending:
+        next_deadline = min(deadlines[name] for name in pending.values())
+        done, _ = wait(pending, timeout=max(0.0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            collection_name = pending.pop(future)
+            try:
+                points_per_query = future.result()
+            except Exception as e:
+                errors[collection_name] = str(e)
+                continue
+            collection_hits = [[(collection_name, point) for point in points] for points in points_per_query]
+            for query_hits, new_hits in zip(hits_per_query, collection_hits):
+                query_hits.extend(new_hits)
+        now = time.monotonic()
+        for future, collection_name in list(pending.items()):
+            if deadlines[collection_name] <= now:
+                # cancel() only stops a search that has not started yet; one that is already
+                # running keeps its pool worker until Qdrant answers or its own timeout passes
+                future.cancel()
+                del pending[future]
+                errors[collection_name] = f"Timed out after {deadlines[collection_name] - started:.1f}s"
+    return hits_per_query, errors
+
+
+# Function to cap the text fields of a payload at max_chars characters
+def truncate_payload(payload, max_chars=DEFAULT_MAX_HIT_CHARS):
+    truncated = False
+    result = {}
+    for key, value in (payload or {}).items():
+        if max_chars and isinstance(value, str) and len(value) > max_chars:
+            value = value[:max_chars].rsplit(" ", 1)[0] + " …"
+            truncated = True
+        result[key] = value
+    return result, truncated
+
+
+# Function to estimate the payload characters field selection kept off the wire for one hit
+def _avoided_chars(collection_name, samples):
+    # Hits of mirrored collections are reported under their base collection's name
+    sample = samples.get(collection_name) or next(
+        (sample for name, sample in samples.items() if sample and name.startswith(collection_name)), None
+    )
+    return max(0.0, sample["full_chars"] - sample["projected_chars"]) if sample else 0.0
+
+
+# Function to turn hits into the score/payload dicts handed to the model, sorted by score
+def format_hits(hits, max_chars=DEFAULT_MAX_HIT_CHARS):
+    with _payload_lock:
+        samples = dict(_payload_samples)
+    formatted_results = []
+    payload_chars = 0
+    avoided_chars = 0.0
+    prompt_chars = 0
+    truncated_hits = 0
+    for collection_name, point in hits:
+        payload, truncated = truncate_payload(point.payload, max_chars)
+        payload_chars += len(json.dumps(point.payload or {}, ensure_ascii=False))
+        avoided_chars += _avoided_chars(collection_name, samples)
+        prompt_chars += len(json.dumps(payload, ensure_ascii=False))
+        truncated_hits += truncated
+        formatted_results.append({
+            "score": point.score,
+            "payload": payload
+        })
+    formatted_results.sort(key=lambda x: x["score"], reverse=True)
+    with _payload_lock:
+        _payload_counters["hits"] += len(hits)
+        _payload_counters["payload_chars"] += payload_chars
+        _payload_counters["avoided_chars"] += int(avoided_chars)
+        _payload_counters["prompt_chars"] += prompt_chars
+        _payload_counters["truncated_hits"] += truncated_hits
+    return formatted_results
+
+
+# Function to report how much payload came over the wire, how much field selection kept on the
+# server (estimated from the per-collection samples) and how much of it reached the prompt
+def payload_metrics():
+    with _payload_lock:
+        counters = dict(_payload_counters)
+        counters["samples"] = {name: dict(sample) for name, sample in _payload_samples.items() if sample}
+    full_chars = counters["payload_chars"] + counters["avoided_chars"]
+    counters["wire_share"] = counters["payload_chars"] / full_chars if full_chars else 0.0
+    counters["prompt_share"] = counters["prompt_chars"] / counters["payload_chars"] if counters["payload_chars"] else 0.0
+    return counters
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import openai
+
+CHAT = "chat"
+EMBEDDINGS = "embeddings"
+
+DEFAULT_LIMITS = {
+    CHAT: {"rpm": 500, "tpm": 30000},
+    EMBEDDINGS: {"rpm": 3000, "tpm": 1000000},
+}
+DEFAULT_COMPLETION_RESERVE = 1000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+
+# Function to estimate the tokens of a text without a tokenizer (about four characters per token)
+def estimate_tokens(text):
+    return len(text or "") // 4 + 1
+
+
+# Function to parse OpenAI reset durations such as "1s", "6m0s", "20ms" or "1h2m3.5s" into seconds
+def parse_duration(value):
+    if not value:
+        return None
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+# Function to read how long the server asked us to wait from a response's headers
+def retry_after(headers):
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+# Function to map a request path to the endpoint family it belongs to
+def endpoint_name(path):
+    return EMBEDDINGS if path.rstrip("/").endswith("/embeddings") else CHAT
+
+
+# Function to read the model of an OpenAI API request from its JSON body (None if unknown)
+def request_model(request):
+    try:
+        return json.loads(request.content).get("model")
+    except Exception:
+        return None
+
+
+class TokenBucket:
+    # Refills to capacity over one minute; amounts larger than capacity are clamped so they can still run
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount):
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60.0 / self.capacity
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    # Adopt the server's view: its limit becomes our capacity and we never assume more is left than it reports
+    def sync(self, limit, remaining):
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+
+class _Ticket:
+    def __init__(self, tokens, grant):
+        self.tokens = tokens
+        self.grant = grant
+        self.cancelled = False
+        self.enqueued = time.monotonic()
+
+
+class RateLimiter:
+    # Process-wide limiter for one OpenAI endpoint family and model (OpenAI's limits and
+    # x-ratelimit-* headers are per model), aware of both requests and tokens per minute.
+    # Callers wait in per-session queues that are served round-robin, so one busy session
+    # cannot starve the others. Rate-limit response headers resync the buckets, and a 429
+    # pauses every caller until the server's retry-after has passed.
+    def __init__(self, name, rpm, tpm):
+        self.name = name
+        self._condition = threading.Condition()
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._waiting = OrderedDict()
+        self._paused_until = 0.0
+        self._worker = None
+        self._counters = {
+            "granted": 0,
+            "queued": 0,
+            "wait_seconds": 0.0,
+            "throttled": 0,
+            "retries": 0,
+            "header_updates": 0,
+        }
+
+    def _affordable(self, tokens, now):
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        return max(self._requests.wait_time(1), self._tokens.wait_time(tokens))
+
+    def _take(self, tokens):
+        self._requests.take(1)
+        self._tokens.take(tokens)
+        self._counters["granted"] += 1
+
+    def _enqueue(self, tokens, session, grant):
+        with self._condition:
+            now = time.monotonic()
+            # Run at once when nobody is waiting and there is capacity
+            if not self._waiting and self._affordable(tokens, now) == 0:
+                self._take(tokens)
+                return None
+            ticket = _Ticket(tokens, grant)
+            self._waiting.setdefault(session, deque()).append(ticket)
+            self._counters["queued"] += 1
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=f"rate-limiter-{self.name}", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+            return ticket
+
+    # Serve waiting sessions round-robin, one request each, as capacity becomes available
+    def _run(self):
+        with self._condition:
+            while True:
+                if not self._waiting:
+                    self._condition.wait()
+                    continue
+                session, tickets = next(iter(self._waiting.items()))
+                ticket = tickets[0]
+                if ticket.cancelled:
+                    self._pop(session)
+                    continue
+                now = time.monotonic()
+                delay = self._affordable(ticket.tokens, now)
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                self._take(ticket.tokens)
+                self._counters["wait_seconds"] += now - ticket.enqueued
+                self._pop(session)
+                ticket.grant()
+
+    def _pop(self, session):
+        tickets = self._waiting.pop(session)
+        tickets.popleft()
+        if tickets:
+            # Back of the line, behind every other waiting session
+            self._waiting[session] = tickets
+
+    # Block until a request estimated at `tokens` tokens may be sent
+    def acquire(self, tokens, session=None):
+        granted = threading.Event()
+        if self._enqueue(tokens, session, granted.set) is not None:
+            granted.wait()
+
+    async def acquire_async(self, tokens, session=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        ticket = self._enqueue(tokens, session, grant)
+        if ticket is None:
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            ticket.cancelled = True
+            raise
+
+    # Function to resync the buckets from OpenAI's x-ratelimit-* response headers
+    def observe(self, headers, status_code=None):
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        with self._condition:
+            if limit_requests or remaining_requests or limit_tokens or remaining_tokens:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+                self._requests.sync(limit_requests and int(limit_requests), remaining_requests and int(remaining_requests))
+                self._tokens.sync(limit_tokens and int(limit_tokens), remaining_tokens and int(remaining_tokens))
+                self._counters["header_updates"] += 1
+            if status_code == 429:
+                wait = retry_after(headers) or parse_duration(headers.get("x-ratelimit-reset-requests")) or DEFAULT_BACKOFF
+                self._pause(wait)
+            self._condition.notify()
+
+    def _pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._counters["throttled"] += 1
+
+    def record_retry(self):
+        with self._condition:
+            self._counters["retries"] += 1
+
+    def stats(self):
+        with self._condition:
+            counters = dict(self._counters)
+            counters["waiting"] = sum(len(tickets) for tickets in self._waiting.values())
+            counters["waiting_sessions"] = len(self._waiting)
+            counters["rpm"] = self._requests.capacity
+            counters["tpm"] = self._tokens.capacity
+        counters["mean_wait_seconds"] = counters["wait_seconds"] / counters["granted"] if counters["granted"] else 0.0
+        return counters
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+# Function to get the process-wide limiter for a model on "chat" or "embeddings" (shared by
+# all sessions). rpm/tpm only apply when the limiter is first created; response headers
+# adjust them later.
+def get_rate_limiter(endpoint, model, rpm=None, tpm=None):
+    name = f"{endpoint}:{model}"
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            defaults = DEFAULT_LIMITS.get(endpoint, DEFAULT_LIMITS[CHAT])
+            limiter = RateLimiter(name, rpm or defaults["rpm"], tpm or defaults["tpm"])
+            _limiters[name] = limiter
+        return limiter
+
+
+# Function to report every limiter's counters
+def rate_limit_metrics():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+def _retry_delay(error, attempt, backoff, max_backoff):
+    delay = min(max_backoff, backoff * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    return max(delay, retry_after(getattr(getattr(error, "response", None), "headers", None)) or 0.0)
+
+
+# Function to call the OpenAI API under a limiter, retrying rate limits, timeouts and
+# server errors with jittered exponential backoff. function takes no arguments.
+def call_with_limits(limiter, function, tokens, session=None, max_retries=DEFAULT_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens, session)
+        try:
+            return function()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = _retry_delay(e, attempt, DEFAULT_BACKOFF, DEFAULT_MAX_BACKOFF)
+            limiter.record_retry()
+            print(f"OpenAI {limiter.name} call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# Async variant of call_with_limits; function returns an awaitable
+async def call_with_limits_async(limiter, function, tokens, session=None, max_retries=DEFAULT_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        await limiter.acquire_async(tokens, session)
+        try:
+            return await function()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = _retry_delay(e, attempt, DEFAULT_BACKOFF, DEFAULT_MAX_BACKOFF)
+            limiter.record_retry()
+            print(f"OpenAI {limiter.name} call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
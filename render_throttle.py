@@ -0,0 +1,54 @@
+import time
+
+DEFAULT_MAX_HZ = 12
+DEFAULT_FLUSH_CHARS = 400
+CURSOR = "▌"
+
+
+class RenderScheduler:
+    # Coalesces streamed text for several Streamlit placeholders (e.g. chat and letter pane)
+    # and re-renders them at most max_hz times per second, or sooner once flush_chars new
+    # characters have arrived. flush() always renders whatever is pending.
+    def __init__(self, max_hz=DEFAULT_MAX_HZ, flush_chars=DEFAULT_FLUSH_CHARS, cursor=CURSOR):
+        self.interval = 1.0 / max_hz if max_hz else 0.0
+        self.flush_chars = flush_chars
+        self.cursor = cursor
+        self._placeholders = {}
+        self._texts = {}
+        self._rendered = {}
+        self._last_flush = 0.0
+        self._chars_since_flush = 0
+        self.updates = 0
+        self.renders = 0
+
+    def add(self, name, placeholder):
+        self._placeholders[name] = placeholder
+        self._texts[name] = ""
+        self._rendered[name] = None
+
+    # Record the latest full text of one or more panes and render if a flush is due
+    def update(self, **texts):
+        for name, text in texts.items():
+            previous = self._texts.get(name, "")
+            if text != previous:
+                self._chars_since_flush += abs(len(text) - len(previous))
+                self._texts[name] = text
+                self.updates += 1
+        now = time.monotonic()
+        if now - self._last_flush >= self.interval or (self.flush_chars and self._chars_since_flush >= self.flush_chars):
+            self._render(self.cursor)
+
+    # Render every pane that changed since the last render; final=True drops the cursor
+    def flush(self, final=False):
+        self._render("" if final else self.cursor)
+
+    def _render(self, cursor):
+        for name, placeholder in self._placeholders.items():
+            text = self._texts[name]
+            shown = text + cursor if text else text
+            if shown != self._rendered[name]:
+                placeholder.markdown(shown)
+                self._rendered[name] = shown
+                self.renders += 1
+        self._last_flush = time.monotonic()
+        self._chars_since_flush = 0
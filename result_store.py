@@ -0,0 +1,124 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+HANDLE_PREFIX = "res_"
+
+
+class ResultStore:
+    # Process-wide, content-addressed store for tool outputs. Session history keeps only a
+    # handle plus a short summary; identical results from different sessions share one
+    # entry. The least recently used entries are evicted once max_bytes is exceeded.
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"puts": 0, "deduplicated": 0, "gets": 0, "missing": 0, "evicted": 0}
+
+    # Store serialized content and return its handle
+    def put(self, content):
+        handle = HANDLE_PREFIX + hashlib.sha256(content.encode("utf-8")).hexdigest()[:24]
+        with self._lock:
+            self._counters["puts"] += 1
+            if handle in self._entries:
+                self._counters["deduplicated"] += 1
+                self._entries.move_to_end(handle)
+                return handle
+            self._entries[handle] = content
+            self._bytes += len(content)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._counters["evicted"] += 1
+        return handle
+
+    def get(self, handle):
+        with self._lock:
+            self._counters["gets"] += 1
+            content = self._entries.get(handle)
+            if content is None:
+                self._counters["missing"] += 1
+                return None
+            self._entries.move_to_end(handle)
+            return content
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "entries": len(self._entries), "bytes": self._bytes}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Function to get the process-wide result store (shared by all Streamlit sessions)
+def get_result_store(max_bytes=DEFAULT_MAX_BYTES):
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ResultStore(max_bytes)
+        return _store
+
+
+# Function to describe search results in one line: hit count and the sources they came from
+def summarize_results(name, results):
+    if not isinstance(results, list):
+        return f"[Resultat från {name}]"
+    sources = []
+    for result in results:
+        payload = (result.get("payload") or {}) if isinstance(result, dict) else {}
+        title = payload.get("title")
+        if title:
+            sources.append(f"{title} ({payload['url']})" if payload.get("url") else title)
+    listed = "; ".join(dict.fromkeys(sources)) or "inga källor"
+    return f"[{name}: {len(results)} träffar. Källor: {listed}]"
+
+
+# Function to build a history message that references the full result by handle.
+# With a tool_call_id it is a "tool" message answering that call, otherwise a legacy "function" message.
+def tool_result_message(name, results, store=None, tool_call_id=None):
+    store = store or get_result_store()
+    message = {
+        "role": "tool" if tool_call_id else "function",
+        "name": name,
+        "content": summarize_results(name, results),
+        "result_handle": store.put(json.dumps(results, ensure_ascii=False)),
+    }
+    if tool_call_id:
+        message["tool_call_id"] = tool_call_id
+    return message
+
+
+# Function to get the full content of a message, falling back to its summary if evicted
+def materialize_content(message, store=None):
+    handle = message.get("result_handle")
+    if handle is None:
+        return message["content"]
+    content = (store or get_result_store()).get(handle)
+    return content if content is not None else message["content"]
+
+
+# Function to load the full result behind a message (None if it has been evicted)
+def load_results(handle, store=None):
+    content = (store or get_result_store()).get(handle)
+    return json.loads(content) if content is not None else None
+
+
+# Function to format a history message the way it is sent to the chat API, loading stored results
+def api_message(message, store=None):
+    result = {"role": message["role"], "content": materialize_content(message, store)}
+    if message["role"] == "function":
+        result["name"] = message["name"]
+    if message.get("tool_calls"):
+        result["tool_calls"] = message["tool_calls"]
+    if message.get("tool_call_id"):
+        result["tool_call_id"] = message["tool_call_id"]
+    return result
+
+
+# Function to turn history messages into chat API messages with results materialized
+def materialize_messages(messages, store=None):
+    return [api_message(m, store) for m in messages]
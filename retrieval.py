@@ -0,0 +1,105 @@
+from context_packer import DEFAULT_TOKEN_BUDGET, pack_context
+from qdrant_search import DEFAULT_MAX_HIT_CHARS, DEFAULT_PAYLOAD_FIELDS, DEFAULT_SEARCH_TIMEOUT, format_hits, search_collections_batch
+from sparse_index import DEFAULT_RRF_K, reciprocal_rank_fusion
+
+DEFAULT_COLLECTIONS = ["FalkenbergsKommunsHemsida", "mediawiki"]
+DEFAULT_LIMIT = 3
+
+
+class Retriever:
+    # The search_qdrant pipeline without any UI: embed the queries in one request, search
+    # every collection concurrently, project and truncate the payloads and pack each query's
+    # hits into its share of the context token budget. With a sparse_index the keyword side
+    # runs too and both rankings are merged with reciprocal rank fusion, so exact terms such
+    # as street and regulation names are not lost in the embedding. Errors are returned, not
+    # raised, so callers decide how to show them.
+    def __init__(
+        self,
+        embedding_backend,
+        qdrant_client,
+        collections=DEFAULT_COLLECTIONS,
+        timeout=DEFAULT_SEARCH_TIMEOUT,
+        result_cache=None,
+        payload_fields=DEFAULT_PAYLOAD_FIELDS,
+        max_hit_chars=DEFAULT_MAX_HIT_CHARS,
+        token_budget=DEFAULT_TOKEN_BUDGET,
+        model="gpt-4o",
+        sparse_index=None,
+        fusion_k=DEFAULT_RRF_K,
+    ):
+        self.embedding_backend = embedding_backend
+        self.qdrant_client = qdrant_client
+        self.collections = list(collections)
+        self.timeout = timeout
+        self.result_cache = result_cache
+        self.payload_fields = payload_fields
+        self.max_hit_chars = max_hit_chars
+        self.token_budget = token_budget
+        self.model = model
+        self.sparse_index = sparse_index
+        self.fusion_k = fusion_k
+
+    # Run several search_qdrant queries ({"user_input", "limit"} dicts), splitting the token
+    # budget across them. Returns (results_per_query, errors) with errors keyed by collection
+    # name or "embedding".
+    def search_batch(self, queries):
+        queries = [query for query in queries if query.get('user_input')]
+        if not queries:
+            return [], {}
+        print('Searching', [query['user_input'] for query in queries])
+        texts = [query['user_input'] for query in queries]
+        limits = [query.get('limit', DEFAULT_LIMIT) for query in queries]
+        sparse_hits = self.sparse_index.search_batch(texts, limits) if self.sparse_index is not None else None
+
+        try:
+            query_embeddings = self.embedding_backend.embed_many(texts)
+        except Exception as e:
+            if sparse_hits is None:
+                return [[] for _ in queries], {"embedding": str(e)}
+            # Keyword hits still answer the queries without embeddings
+            hits_per_query, errors = [[] for _ in queries], {"embedding": str(e)}
+        else:
+            dense_names = {self.embedding_backend.collection_name(name): name for name in self.collections}
+            hits_per_query, errors = search_collections_batch(
+                self.qdrant_client,
+                list(dense_names),
+                query_embeddings,
+                limits,
+                timeout=self.timeout,
+                result_cache=self.result_cache,
+                payload_fields=self.payload_fields,
+            )
+            # Mirrored collections share ids with the collection the sparse index was built from
+            hits_per_query = [[(dense_names[name], point) for name, point in hits] for hits in hits_per_query]
+
+        if sparse_hits is not None:
+            hits_per_query = [
+                reciprocal_rank_fusion(
+                    [sorted(dense, key=lambda hit: hit[1].score, reverse=True), sparse],
+                    limit * len(self.collections),
+                    self.fusion_k,
+                )
+                for dense, sparse, limit in zip(hits_per_query, sparse_hits, limits)
+            ]
+
+        # Keep the hits that fit the context budget, dropping overlapping chunks first
+        all_results = []
+        for hits in hits_per_query:
+            packed_results, report = pack_context(
+                format_hits(hits, self.max_hit_chars),
+                token_budget=self.token_budget // len(queries),
+                model=self.model,
+            )
+            print('Packed context', report)
+            all_results.append(packed_results)
+        return all_results, errors
+
+    # Re-pack results of one query into its share of the budget split across `share` queries
+    def fit(self, results, share):
+        packed_results, _ = pack_context(results, token_budget=self.token_budget // max(1, share), model=self.model)
+        return packed_results
+
+    # Run one query; returns (results, errors)
+    def search(self, user_input, limit=DEFAULT_LIMIT):
+        results, errors = self.search_batch([{"user_input": user_input, "limit": limit}])
+        return (results[0] if results else []), errors
@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+
+import numpy as np
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.97
+DEFAULT_TTL = 3600.0
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_VERSION_CHECK_INTERVAL = 30.0
+# Collection metadata key that ingestion bumps after writing; point counts alone miss in-place upserts
+CONTENT_VERSION_KEY = "content_version"
+
+
+# Function to read a marker that changes whenever a collection's contents change. Indexed
+# vector and segment counts are left out: the optimizer changes them without any write.
+def collection_version(qdrant_client, collection_name):
+    info = qdrant_client.get_collection(collection_name)
+    metadata = getattr(info.config, "metadata", None) or {}
+    return (metadata.get(CONTENT_VERSION_KEY), info.points_count)
+
+
+# Function for ingestion code to call after writing to a collection, so every process's
+# result caches and sparse indexes see a new version even if the point count is unchanged
+def mark_collection_changed(qdrant_client, collection_name):
+    qdrant_client.update_collection(collection_name, metadata={CONTENT_VERSION_KEY: uuid.uuid4().hex})
+
+
+class SemanticResultCache:
+    # Caches search hits per collection keyed on the query embedding. A new query reuses a
+    # cached hit list when its cosine similarity to a cached query is above the threshold.
+    # Entries expire after ttl seconds and a collection's entries are dropped when its
+    # version marker (content_version metadata and point count) changes.
+    def __init__(
+        self,
+        threshold=DEFAULT_SIMILARITY_THRESHOLD,
+        ttl=DEFAULT_TTL,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        version_check_interval=DEFAULT_VERSION_CHECK_INTERVAL,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._collections = {}
+        self._versions = {}
+        self._counters = {"hits": 0, "misses": 0, "invalidations": 0, "expired": 0}
+
+    def _empty(self, dimension):
+        return {
+            "vectors": np.empty((0, dimension), dtype=np.float32),
+            "entries": [],
+        }
+
+    # Check the collection version at most every version_check_interval seconds
+    def _check_version(self, qdrant_client, collection_name):
+        now = time.monotonic()
+        with self._lock:
+            known = self._versions.get(collection_name)
+            if known is not None and now - known[1] < self.version_check_interval:
+                return
+        try:
+            version = collection_version(qdrant_client, collection_name)
+        except Exception as e:
+            print(f"Could not read version of {collection_name}: {e}")
+            return
+        with self._lock:
+            known = self._versions.get(collection_name)
+            if known is not None and known[0] != version and collection_name in self._collections:
+                del self._collections[collection_name]
+                self._counters["invalidations"] += 1
+            self._versions[collection_name] = (version, now)
+
+    # Drop cached hits for one collection, or for all of them, in this process
+    def invalidate(self, collection_name=None):
+        with self._lock:
+            names = list(self._collections) if collection_name is None else [collection_name]
+            for name in names:
+                if self._collections.pop(name, None) is not None:
+                    self._counters["invalidations"] += 1
+
+    def _drop_expired(self, collection):
+        now = time.monotonic()
+        keep = [index for index, entry in enumerate(collection["entries"]) if now - entry["created"] < self.ttl]
+        if len(keep) != len(collection["entries"]):
+            self._counters["expired"] += len(collection["entries"]) - len(keep)
+            collection["entries"] = [collection["entries"][index] for index in keep]
+            collection["vectors"] = collection["vectors"][keep]
+
+    def lookup(self, qdrant_client, collection_name, query_vector, limit, variant=None):
+        self._check_version(qdrant_client, collection_name)
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            if collection is None or not collection["entries"]:
+                self._counters["misses"] += 1
+                return None
+            self._drop_expired(collection)
+            if not collection["entries"] or collection["vectors"].shape[1] != query.shape[0]:
+                self._counters["misses"] += 1
+                return None
+            similarities = collection["vectors"] @ query
+            for index in np.argsort(-similarities):
+                if similarities[index] < self.threshold:
+                    break
+                entry = collection["entries"][index]
+                if entry["limit"] >= limit and entry["variant"] == variant:
+                    self._counters["hits"] += 1
+                    return entry["points"][:limit]
+            self._counters["misses"] += 1
+            return None
+
+    def store(self, qdrant_client, collection_name, query_vector, limit, points, variant=None):
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            if collection is None or collection["vectors"].shape[1] != query.shape[0]:
+                collection = self._empty(query.shape[0])
+                self._collections[collection_name] = collection
+            collection["entries"].append({
+                "limit": limit,
+                "variant": variant,
+                "points": list(points),
+                "created": time.monotonic(),
+            })
+            collection["vectors"] = np.vstack([collection["vectors"], query[None, :]])
+            if len(collection["entries"]) > self.max_entries:
+                overflow = len(collection["entries"]) - self.max_entries
+                collection["entries"] = collection["entries"][overflow:]
+                collection["vectors"] = collection["vectors"][overflow:]
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = sum(len(collection["entries"]) for collection in self._collections.values())
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / lookups if lookups else 0.0
+        return counters
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+# Function to get the process-wide result cache (shared by all Streamlit sessions)
+def get_semantic_result_cache(threshold=DEFAULT_SIMILARITY_THRESHOLD, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = SemanticResultCache(threshold, ttl, max_entries)
+        return _result_cache
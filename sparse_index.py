@@ -0,0 +1,303 @@
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+import snowballstemmer
+from qdrant_client.models import ScoredPoint
+
+from qdrant_search import DEFAULT_PAYLOAD_FIELDS, payload_fields_for
+from semantic_cache import DEFAULT_VERSION_CHECK_INTERVAL, collection_version
+
+DEFAULT_TEXT_FIELD = "chunk"
+DEFAULT_RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+SCROLL_BATCH = 256
+# Compound splitting: parts need at least this many letters and must occur this often in the corpus
+MIN_COMPOUND_LENGTH = 8
+MIN_PART_LENGTH = 3
+MIN_PART_COUNT = 2
+
+SWEDISH_STOPWORDS = frozenset("""
+alla allt att av blev bli blir de dem den denna dens der dess dessa det detta dig din dina ditt du där då efter ej
+eller en er era ert ett från för ha hade han hans har henne hennes hon honom hur här i icke ingen inom inte jag ju
+kan kunde man med mellan men mig min mina mitt mot mycket ni nu när någon något några och om oss på samma sedan sig
+sin sina sitta själv skulle som så sådan sådana till under upp ut utan vad var vara varför varit varje vars vem vi
+vid vilka vilkas vilken vilket vår våra vårt än är åt över
+""".split())
+
+
+class SwedishAnalyzer:
+    # Turns text into BM25 terms: lowercased words without stopwords, Snowball-stemmed, with
+    # long compounds ("lekplatsområde") also indexed as their parts ("lek", "plats", "område")
+    # when those parts (or their stems) are words of the corpus. Linking s ("bygglovsansökan")
+    # and a dropped final a ("skolgård") are recognised.
+    def __init__(self, lexicon=()):
+        self._stemmer = snowballstemmer.stemmer("swedish")
+        self._stems = {}
+        self._compounds = {}
+        self._lexicon = frozenset(lexicon)
+        self._stem_lexicon = frozenset(self.stem(word) for word in self._lexicon)
+
+    def words(self, text):
+        return [word for word in re.findall(r"[^\W\d_]+|\d+", (text or "").lower()) if word not in SWEDISH_STOPWORDS]
+
+    def stem(self, word):
+        stem = self._stems.get(word)
+        if stem is None:
+            stem = self._stems[word] = self._stemmer.stemWord(word)
+        return stem
+
+    def _known(self, part):
+        return len(part) >= MIN_PART_LENGTH and (part in self._lexicon or self.stem(part) in self._stem_lexicon)
+
+    # Function to split a compound into known parts (head first), or None
+    def split(self, word, depth=2):
+        if word in self._compounds:
+            return self._compounds[word]
+        parts = None
+        for index in range(MIN_PART_LENGTH, len(word) - MIN_PART_LENGTH + 1):
+            head, tail = word[:index], word[index:]
+            heads = [candidate for candidate in (head, head[:-1] if head.endswith("s") else None, head + "a") if candidate]
+            head = next((candidate for candidate in heads if self._known(candidate)), None)
+            if head is None:
+                continue
+            if self._known(tail):
+                parts = [head, tail]
+                break
+            tail_parts = self.split(tail, depth - 1) if depth > 1 and len(tail) >= MIN_COMPOUND_LENGTH else None
+            if tail_parts:
+                parts = [head] + tail_parts
+                break
+        self._compounds[word] = parts
+        return parts
+
+    # Function to turn words into terms: each word's stem plus the stems of its compound parts
+    def expand(self, words):
+        terms = []
+        for word in words:
+            terms.append(self.stem(word))
+            if len(word) >= MIN_COMPOUND_LENGTH:
+                terms.extend(self.stem(part) for part in self.split(word) or ())
+        return terms
+
+    def terms(self, text):
+        return self.expand(self.words(text))
+
+
+class Bm25Index:
+    # Immutable BM25 index over documents [(collection_name, point_id, payload, text)]. Each
+    # term keeps its postings as numpy arrays of document numbers and precomputed BM25 weights,
+    # so a query is a handful of vectorised adds.
+    def __init__(self, documents):
+        self.documents = documents
+        lexicon = Counter()
+        analyzer = SwedishAnalyzer()
+        tokenized = []
+        for _, _, _, text in documents:
+            words = analyzer.words(text)
+            lexicon.update(words)
+            tokenized.append(words)
+        self.analyzer = SwedishAnalyzer(word for word, count in lexicon.items() if count >= MIN_PART_COUNT)
+
+        postings = defaultdict(list)
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for number, words in enumerate(tokenized):
+            terms = Counter(self.analyzer.expand(words))
+            lengths[number] = sum(terms.values())
+            for term, frequency in terms.items():
+                postings[term].append((number, frequency))
+
+        average_length = float(lengths.mean()) if len(documents) else 1.0
+        self.postings = {}
+        for term, entries in postings.items():
+            numbers = np.fromiter((number for number, _ in entries), dtype=np.int32, count=len(entries))
+            frequencies = np.fromiter((frequency for _, frequency in entries), dtype=np.float32, count=len(entries))
+            idf = math.log(1 + (len(documents) - len(entries) + 0.5) / (len(entries) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[numbers] / max(average_length, 1.0))
+            self.postings[term] = (numbers, (idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)).astype(np.float32))
+
+        # Documents are stored collection by collection, so each collection is one slice
+        self.ranges = {}
+        for number, (collection_name, _, _, _) in enumerate(documents):
+            start, _ = self.ranges.get(collection_name, (number, number))
+            self.ranges[collection_name] = (start, number + 1)
+
+    # Function to score a query and return the top `limit` hits per collection as (collection_name, point)
+    def search(self, text, limit, collections=None):
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        matched = False
+        for term, count in Counter(self.analyzer.terms(text)).items():
+            entry = self.postings.get(term)
+            if entry is not None:
+                scores[entry[0]] += count * entry[1]
+                matched = True
+        hits = []
+        if not matched:
+            return hits
+        for collection_name in collections or self.ranges:
+            if collection_name not in self.ranges:
+                continue
+            start, end = self.ranges[collection_name]
+            window = scores[start:end]
+            top = np.argpartition(-window, min(limit, len(window)) - 1)[:limit] if len(window) > limit else np.arange(len(window))
+            for offset in sorted(top, key=lambda offset: -window[offset]):
+                if window[offset] <= 0:
+                    continue
+                _, point_id, payload, _ = self.documents[start + offset]
+                hits.append((collection_name, ScoredPoint(id=point_id, version=0, score=float(window[offset]), payload=payload)))
+        hits.sort(key=lambda hit: hit[1].score, reverse=True)
+        return hits
+
+
+# Function to read every point's text and projected payload from the collections
+def load_documents(qdrant_client, collections, text_field=DEFAULT_TEXT_FIELD, payload_fields=DEFAULT_PAYLOAD_FIELDS):
+    documents = []
+    for collection_name in collections:
+        fields = payload_fields_for(collection_name, payload_fields)
+        offset = None
+        while True:
+            points, offset = qdrant_client.scroll(
+                collection_name=collection_name,
+                limit=SCROLL_BATCH,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False,
+            )
+            for point in points:
+                payload = point.payload or {}
+                if payload.get(text_field):
+                    projected = {key: value for key, value in payload.items() if key in fields} if fields else payload
+                    documents.append((collection_name, point.id, projected, payload[text_field]))
+            if offset is None:
+                break
+    return documents
+
+
+class SparseIndex:
+    # Keyword side of hybrid search: a BM25 index over the chunk payloads of the collections,
+    # built in a background thread on first use. The same thread rebuilds it when a collection's
+    # version marker changes or invalidate() is called. Until the first build is done searches
+    # return None and callers stay dense-only.
+    def __init__(
+        self,
+        qdrant_client,
+        collections,
+        text_field=DEFAULT_TEXT_FIELD,
+        payload_fields=DEFAULT_PAYLOAD_FIELDS,
+        version_check_interval=DEFAULT_VERSION_CHECK_INTERVAL,
+    ):
+        self.qdrant_client = qdrant_client
+        self.collections = list(collections)
+        self.text_field = text_field
+        self.payload_fields = payload_fields
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._index = None
+        self._versions = None
+        self._worker = None
+        self._wakeup = threading.Event()
+        self._counters = {"builds": 0, "build_seconds": 0.0, "searches": 0, "search_seconds": 0.0, "errors": 0}
+
+    def _versions_now(self):
+        return {name: collection_version(self.qdrant_client, name) for name in self.collections}
+
+    def _build(self, versions):
+        started = time.monotonic()
+        index = Bm25Index(load_documents(self.qdrant_client, self.collections, self.text_field, self.payload_fields))
+        elapsed = time.monotonic() - started
+        print(f"Built sparse index: {len(index.documents)} chunks, {len(index.postings)} terms in {elapsed:.1f}s")
+        with self._lock:
+            self._index = index
+            self._versions = versions
+            self._counters["builds"] += 1
+            self._counters["build_seconds"] += elapsed
+
+    # Background loop: build the index, then check the collection versions every
+    # version_check_interval seconds (or when invalidated) and rebuild when they changed.
+    # Searches never wait on Qdrant round-trips.
+    def _run(self):
+        while True:
+            try:
+                versions = self._versions_now()
+                with self._lock:
+                    stale = self._index is None or versions != self._versions
+                if stale:
+                    self._build(versions)
+            except Exception as e:
+                print(f"Could not refresh sparse index: {e}")
+                with self._lock:
+                    self._counters["errors"] += 1
+            self._wakeup.wait(self.version_check_interval)
+            self._wakeup.clear()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="sparse-index", daemon=True)
+                self._worker.start()
+
+    # Rebuild on the next background pass, e.g. after writes the version marker cannot see
+    def invalidate(self):
+        with self._lock:
+            self._versions = None
+        self._ensure_worker()
+        self._wakeup.set()
+
+    # Run several keyword queries; returns hits_per_query (lists of (collection_name, point)) or None before the first build
+    def search_batch(self, texts, limits):
+        self._ensure_worker()
+        with self._lock:
+            index = self._index
+        if index is None:
+            return None
+        started = time.monotonic()
+        hits_per_query = [index.search(text, limit, self.collections) for text, limit in zip(texts, limits)]
+        with self._lock:
+            self._counters["searches"] += len(texts)
+            self._counters["search_seconds"] += time.monotonic() - started
+        return hits_per_query
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["ready"] = self._index is not None
+            counters["documents"] = len(self._index.documents) if self._index is not None else 0
+            counters["terms"] = len(self._index.postings) if self._index is not None else 0
+        counters["mean_search_ms"] = 1000 * counters["search_seconds"] / counters["searches"] if counters["searches"] else 0.0
+        return counters
+
+
+# Function to merge ranked hit lists with reciprocal rank fusion. Each list holds
+# (collection_name, point) in rank order; a point found by several lists adds up
+# 1 / (k + rank) from each. Returns the top `limit` hits with the fused score.
+def reciprocal_rank_fusion(ranked_lists, limit, k=DEFAULT_RRF_K):
+    fused = {}
+    for hits in ranked_lists:
+        for rank, (collection_name, point) in enumerate(hits, start=1):
+            key = (collection_name, point.id)
+            score, best = fused.get(key, (0.0, point))
+            fused[key] = (score + 1.0 / (k + rank), best)
+    ranked = sorted(fused.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    return [
+        (collection_name, ScoredPoint(id=point.id, version=point.version, score=score, payload=point.payload))
+        for (collection_name, _), (score, point) in ranked
+    ]
+
+
+_sparse_indexes = {}
+_sparse_indexes_lock = threading.Lock()
+
+
+# Function to get the process-wide sparse index for a Qdrant client and set of collections
+def get_sparse_index(qdrant_client, collections, text_field=DEFAULT_TEXT_FIELD, payload_fields=DEFAULT_PAYLOAD_FIELDS):
+    key = (id(qdrant_client), tuple(collections), text_field)
+    with _sparse_indexes_lock:
+        index = _sparse_indexes.get(key)
+        if index is None:
+            index = SparseIndex(qdrant_client, collections, text_field, payload_fields)
+            _sparse_indexes[key] = index
+        return index
@@ -0,0 +1,110 @@
+import re
+import threading
+import time
+
+POLICY_FIRST = "first"
+POLICY_OVERLAP = "overlap"
+REUSE_POLICIES = (POLICY_FIRST, POLICY_OVERLAP)
+DEFAULT_REUSE_POLICY = POLICY_OVERLAP
+DEFAULT_MIN_OVERLAP = 0.5
+DEFAULT_LIMIT = 3
+
+
+# Function to split text into lowercase words
+def words(text):
+    return set(re.findall(r"\w+", (text or "").lower()))
+
+
+# Function to measure how much of the model's search query is covered by the user input.
+# The model tends to send keyword lists, so this is containment rather than Jaccard.
+def query_overlap(query, user_input):
+    query_words = words(query)
+    if not query_words:
+        return 0.0
+    return len(query_words & words(user_input)) / len(query_words)
+
+
+class SpeculationStats:
+    # Process-wide counters for speculative retrieval: how often a prefetch was reused,
+    # rejected by the reuse policy or never asked for, and how much latency it saved.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {"started": 0, "reused": 0, "rejected": 0, "unused": 0, "time_saved": 0.0}
+
+    def record(self, outcome, time_saved=0.0):
+        with self._lock:
+            self._counters[outcome] += 1
+            self._counters["time_saved"] += time_saved
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters["hit_rate"] = counters["reused"] / counters["started"] if counters["started"] else 0.0
+        counters["mean_time_saved"] = counters["time_saved"] / counters["reused"] if counters["reused"] else 0.0
+        return counters
+
+
+_stats = SpeculationStats()
+
+
+# Function to get the process-wide speculation stats (shared by all Streamlit sessions)
+def get_speculation_stats():
+    return _stats
+
+
+class SpeculativeSearch:
+    # A search for the raw user input started before the model has asked for one. The first
+    # search_qdrant call of the turn may claim it if the reuse policy accepts its query:
+    # "first" reuses it for the first call regardless of query, "overlap" only when at least
+    # min_overlap of the query's words appear in the user input.
+    def __init__(self, user_input, search, submit, policy=DEFAULT_REUSE_POLICY, min_overlap=DEFAULT_MIN_OVERLAP, limit=DEFAULT_LIMIT, stats=None):
+        if policy not in REUSE_POLICIES:
+            raise ValueError(f"Unknown reuse policy {policy!r}, expected one of {REUSE_POLICIES}")
+        self.user_input = user_input
+        self.policy = policy
+        self.min_overlap = min_overlap
+        self.limit = limit
+        self.stats = stats or get_speculation_stats()
+        self.duration = None
+        self._claimed = False
+        self._started = time.monotonic()
+        self.stats.record("started")
+        self.future = submit(lambda: self._run(search))
+
+    def _run(self, search):
+        try:
+            return search(self.user_input, self.limit)
+        finally:
+            self.duration = time.monotonic() - self._started
+
+    def accepts(self, query, limit=DEFAULT_LIMIT):
+        if limit != self.limit:
+            return False
+        return self.policy == POLICY_FIRST or query_overlap(query, self.user_input) >= self.min_overlap
+
+    # Claim the prefetched results for a search the model asked for; returns the future
+    # holding them, or None if the policy rejects the query or it was already claimed
+    def claim(self, query, limit=DEFAULT_LIMIT):
+        if self._claimed:
+            return None
+        self._claimed = True
+        if not self.accepts(query, limit):
+            self.stats.record("rejected")
+            return None
+        claimed_at = time.monotonic()
+
+        # Without the prefetch the search would have started now and taken as long as the prefetch did
+        def record_saved(future):
+            finished_at = self._started + (self.duration or 0.0)
+            saved = claimed_at + (self.duration or 0.0) - max(claimed_at, finished_at)
+            self.stats.record("reused", saved)
+            print(f"Reused speculative search, saved {saved:.2f}s", self.stats.stats())
+
+        self.future.add_done_callback(record_saved)
+        return self.future
+
+    # Record the prefetch as unused if the model never asked for a search this turn
+    def finish(self):
+        if not self._claimed:
+            self._claimed = True
+            self.stats.record("unused")
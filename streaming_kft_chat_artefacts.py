@@ -1,8 +1,14 @@
+import uuid
+
 import streamlit as st
-from openai import OpenAI
-from qdrant_client import QdrantClient
+from clients import get_openai_client, get_qdrant_client
 import requests
 import json
+from embedding_backends import DEFAULT_LOCAL_MODEL, get_embedding_backend
+from embedding_cache import DEFAULT_CACHE_PATH
+from embedding_service import DEFAULT_BATCH_WINDOW
+from rate_limiter import CHAT, DEFAULT_COMPLETION_RESERVE, call_with_limits, estimate_tokens, get_rate_limiter
+from result_store import load_results, materialize_messages, tool_result_message
 
 # Set page config
 st.set_page_config(page_title="AI Chat with Qdrant Search", layout="wide")
@@ -23,18 +29,29 @@ st.markdown(css, unsafe_allow_html=True)
 
 
 # Set up OpenAI and Qdrant clients
-openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-qdrant_client = QdrantClient(url=st.secrets["qdrant_url"], port=443, api_key=st.secrets["qdrant_api_key"])
+openai_client = get_openai_client(st.secrets["OPENAI_API_KEY"])
+qdrant_client = get_qdrant_client(
+    st.secrets["qdrant_url"],
+    api_key=st.secrets["qdrant_api_key"],
+    prefer_grpc=st.secrets.get("qdrant_prefer_grpc", False),
+)
 
 # Constants
 GPT_MODEL = "gpt-4o"  # Make sure this is the correct model name
 EMBEDDING_MODEL = "text-embedding-3-large"
+embedding_backend = get_embedding_backend(
+    st.secrets.get("embedding_backend", "openai"),
+    openai_client=openai_client,
+    openai_model=EMBEDDING_MODEL,
+    local_model=st.secrets.get("local_embedding_model", DEFAULT_LOCAL_MODEL),
+    cache_path=st.secrets.get("embedding_cache_path", DEFAULT_CACHE_PATH),
+    batch_window=st.secrets.get("embedding_batch_window", DEFAULT_BATCH_WINDOW),
+)
 
 # Function to generate embeddings
 def generate_embeddings(text):
     try:
-        response = openai_client.embeddings.create(input=text, model=EMBEDDING_MODEL)
-        return response.data[0].embedding
+        return embedding_backend.embed(text)
     except Exception as e:
         st.error(f"Error generating embeddings: {str(e)}")
         return None
@@ -43,13 +60,13 @@ def generate_embeddings(text):
 def search_collection(qdrant_client, collection_name, user_query_embedding, limit=5):
     print(collection_name)
     try:
-        response = qdrant_client.search(
+        response = qdrant_client.query_points(
             collection_name=collection_name,
-            query_vector=user_query_embedding,
+            query=user_query_embedding,
             limit=limit,
             with_payload=True
         )
-        return response
+        return response.points
     except Exception as e:
         st.error(f"Error searching Qdrant collection: {str(e)}")
         return []
@@ -64,7 +81,7 @@ def search_qdrant(user_input: str, collection_name: str, limit: int = 5):
     if user_query_embedding is None:
         return []
 
-    results = search_collection(qdrant_client, collection_name, user_query_embedding, limit)
+    results = search_collection(qdrant_client, embedding_backend.collection_name(collection_name), user_query_embedding, limit)
     print('search collection done', results)
     formatted_results = []
     for result in results:
@@ -109,12 +126,17 @@ tools = [
 # Function to handle AI response generation
 def generate_ai_response(messages):
     try:
-        completion = openai_client.chat.completions.create(
-            model=GPT_MODEL,
-            messages=messages,
-            tools=tools,
-            tool_choice="auto",
-            stream=True,
+        completion = call_with_limits(
+            get_rate_limiter(CHAT, GPT_MODEL),
+            lambda: openai_client.chat.completions.create(
+                model=GPT_MODEL,
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+                stream=True,
+            ),
+            estimate_tokens(json.dumps(messages, ensure_ascii=False)) + DEFAULT_COMPLETION_RESERVE,
+            session=st.session_state['rate_limit_session'],
         )
         return completion
     except Exception as e:
@@ -150,6 +172,9 @@ if 'last_letter' not in st.session_state:
 if 'tool_calls' not in st.session_state:
     st.session_state['tool_calls'] = []
 
+if 'rate_limit_session' not in st.session_state:
+    st.session_state['rate_limit_session'] = uuid.uuid4().hex
+
 # Sidebar for tool call information
 with st.sidebar:
     st.subheader("Tool Call Information")
@@ -157,7 +182,11 @@ with st.sidebar:
         for call in st.session_state['tool_calls']:
             st.write(f"Function: {call['function']}")
             st.write(f"Arguments: {call['arguments']}")
-            st.json(call['results'])
+            results = load_results(call['result_handle']) if 'result_handle' in call else call.get('results')
+            if results is None:
+                st.write("Results no longer cached.")
+            else:
+                st.json(results)
             st.write("---")
     else:
         st.write("No tool calls made yet.")
@@ -207,7 +236,7 @@ if user_input:
     # Generate AI response
     messages = [
         {"role": "system", "content": "Du är en hjälpsam AI-assistent för Falkenbergs kommun. Använd search_qdrant-funktionen när du behöver hitta information. När du skriver ett utkast till svar för KFT-handläggaren som svar till en invånare, omslut det med <letter></letter>-taggar."}
-    ] + st.session_state.messages
+    ] + materialize_messages(st.session_state.messages)
 
     completion = generate_ai_response(messages)
     if completion:
@@ -219,19 +248,16 @@ if user_input:
                 if tool_call.function.name == "search_qdrant":
                     function_args = safe_json_loads(tool_call.function.arguments)
                     search_results = search_qdrant(**function_args)
-                    st.session_state.messages.append({
-                        "role": "function",
-                        "name": "search_qdrant",
-                        "content": json.dumps(search_results)
-                    })
+                    result_message = tool_result_message("search_qdrant", search_results)
+                    st.session_state.messages.append(result_message)
                     st.session_state['tool_calls'].append({
                         "function": "search_qdrant",
                         "arguments": function_args,
-                        "results": search_results
+                        "result_handle": result_message["result_handle"]
                     })
 
             # Get the final response after function calls
-            completion = generate_ai_response(st.session_state.messages)
+            completion = generate_ai_response(materialize_messages(st.session_state.messages))
             if completion:
                 response_message = completion.choices[0].message
 
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import deque
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Local stand-in for the OpenAI API, for load-testing draft_server.py without real calls.
+# Chat completions first answer with a search_qdrant tool call, then stream a canned
+# reply with a <letter> at a configurable token rate; embeddings are deterministic
+# pseudo-random vectors. With --rpm the stub enforces a requests-per-minute limit, sends
+# OpenAI's x-ratelimit-* headers and answers 429 with retry-after when it is exceeded.
+# Raise the server's chat limits (CHAT_RPM, CHAT_TPM) for load tests: the defaults are sized
+# for the real API and would throttle the stub to a few dozen drafts per minute.
+#
+#   python stub_openai.py --port 8001 --tokens-per-second 60
+#   OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:8001/v1 QDRANT_URL=:memory: \
+#       CHAT_RPM=100000 CHAT_TPM=100000000 uvicorn draft_server:app
+
+DEFAULT_DIMENSIONS = 256
+DEFAULT_TOKENS_PER_SECOND = 60.0
+DEFAULT_FIRST_TOKEN_DELAY = 0.3
+
+REPLY = (
+    "Här är ett förslag på svar. <letter>Hej Namn,\n\nTack för ditt meddelande om lekplatsen. "
+    "Kommunen har tagit emot synpunkten och diariefört den. Vi återkommer när vi har gått igenom ärendet.\n\n"
+    "Med vänliga hälsningar, [Namn], [Avdelning på kommunen]</letter> Källor: https://example.invalid/lekplatser"
+)
+
+settings = {
+    "dimensions": DEFAULT_DIMENSIONS,
+    "tokens_per_second": DEFAULT_TOKENS_PER_SECOND,
+    "first_token_delay": DEFAULT_FIRST_TOKEN_DELAY,
+    "rpm": None,
+}
+request_times = deque()
+
+
+# Function to build a deterministic vector for a text
+def stub_vector(text, dimensions):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    generator = random.Random(seed)
+    return [generator.gauss(0, 1) for _ in range(dimensions)]
+
+
+# Function to count a request against the stub's rate limit; returns (headers, allowed)
+def rate_limit():
+    if not settings["rpm"]:
+        return {}, True
+    now = time.monotonic()
+    while request_times and request_times[0] <= now - 60:
+        request_times.popleft()
+    allowed = len(request_times) < settings["rpm"]
+    if allowed:
+        request_times.append(now)
+    reset = 60 - (now - request_times[0]) if request_times else 0.0
+    headers = {
+        "x-ratelimit-limit-requests": str(settings["rpm"]),
+        "x-ratelimit-remaining-requests": str(settings["rpm"] - len(request_times)),
+        "x-ratelimit-reset-requests": f"{reset:.3f}s",
+    }
+    if not allowed:
+        headers["retry-after-ms"] = str(int(reset * 1000))
+    return headers, allowed
+
+
+def rate_limited(headers):
+    return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, status_code=429, headers=headers)
+
+
+async def embeddings(request):
+    headers, allowed = rate_limit()
+    if not allowed:
+        return rate_limited(headers)
+    body = await request.json()
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    return JSONResponse({
+        "object": "list",
+        "model": body.get("model"),
+        "data": [
+            {"object": "embedding", "index": index, "embedding": stub_vector(text, settings["dimensions"])}
+            for index, text in enumerate(texts)
+        ],
+        "usage": {"prompt_tokens": sum(len(text) // 4 for text in texts), "total_tokens": sum(len(text) // 4 for text in texts)},
+    }, headers=headers)
+
+
+def _chunk(completion_id, model, delta=None, finish_reason=None, usage=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}],
+        "usage": usage,
+    }
+
+
+# Function to decide whether this request should get a search_qdrant call instead of the reply
+def wants_search(body):
+    offered = {tool["function"]["name"] for tool in body.get("tools") or []}
+    answered = any(message.get("role") in ("tool", "function") for message in body["messages"])
+    return "search_qdrant" in offered and body.get("tool_choice") != "none" and not answered
+
+
+async def chat_completions(request):
+    headers, allowed = rate_limit()
+    if not allowed:
+        return rate_limited(headers)
+    body = await request.json()
+    model = body.get("model", "stub")
+    completion_id = f"chatcmpl-{random.getrandbits(48):x}"
+    prompt_tokens = sum(len(json.dumps(message, ensure_ascii=False)) // 4 for message in body["messages"])
+    user_input = next((m["content"] for m in reversed(body["messages"]) if m["role"] == "user"), "")
+
+    if not body.get("stream"):
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "Sammanfattning."}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 2, "total_tokens": prompt_tokens + 2},
+        }, headers=headers)
+
+    async def stream():
+        await asyncio.sleep(settings["first_token_delay"])
+        if wants_search(body):
+            arguments = json.dumps({"user_input": user_input[:200]}, ensure_ascii=False)
+            pieces = [arguments[i:i + 8] for i in range(0, len(arguments), 8)]
+            for index, piece in enumerate(pieces):
+                tool_call = {"index": 0, "function": {"arguments": piece}}
+                if index == 0:
+                    tool_call.update({"id": f"call_{random.getrandbits(32):x}", "type": "function"})
+                    tool_call["function"]["name"] = "search_qdrant"
+                yield f"data: {json.dumps(_chunk(completion_id, model, {'tool_calls': [tool_call]}))}\n\n"
+            finish_reason = "tool_calls"
+            completion_tokens = len(pieces)
+        else:
+            tokens = [REPLY[i:i + 4] for i in range(0, len(REPLY), 4)]
+            delay = 1.0 / settings["tokens_per_second"] if settings["tokens_per_second"] else 0.0
+            for token in tokens:
+                yield f"data: {json.dumps(_chunk(completion_id, model, {'content': token}), ensure_ascii=False)}\n\n"
+                await asyncio.sleep(delay)
+            finish_reason = "stop"
+            completion_tokens = len(tokens)
+        yield f"data: {json.dumps(_chunk(completion_id, model, finish_reason=finish_reason))}\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+            yield f"data: {json.dumps(_chunk(completion_id, model, usage=usage))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+
+app = Starlette(routes=[
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/v1/embeddings", embeddings, methods=["POST"]),
+])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--dimensions", type=int, default=DEFAULT_DIMENSIONS)
+    parser.add_argument("--tokens-per-second", type=float, default=DEFAULT_TOKENS_PER_SECOND)
+    parser.add_argument("--first-token-delay", type=float, default=DEFAULT_FIRST_TOKEN_DELAY)
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute before answering 429")
+    args = parser.parse_args()
+    settings.update(dimensions=args.dimensions, tokens_per_second=args.tokens_per_second, first_token_delay=args.first_token_delay, rpm=args.rpm)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
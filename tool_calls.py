@@ -0,0 +1,114 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_TOOL_WORKERS = 8
+
+# Shared by all sessions so concurrent tool execution stays bounded per process
+_tool_executor = ThreadPoolExecutor(max_workers=MAX_TOOL_WORKERS, thread_name_prefix="tool-call")
+
+
+class JsonObjectScanner:
+    # Incremental scanner over streamed argument text that reports each top-level JSON
+    # object as soon as its closing brace arrives (strings and escapes are respected).
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._buffer = []
+
+    def feed(self, text):
+        completed = []
+        for char in text:
+            if self._depth == 0 and char != "{":
+                continue
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed.append("".join(self._buffer))
+                    self._buffer = []
+        return completed
+
+
+class ToolCallAccumulator:
+    # Collects streamed tool call deltas per index, so parallel tool calls in one
+    # assistant turn each get their own id, name and argument buffer.
+    def __init__(self):
+        self._calls = {}
+        self._scanners = {}
+
+    # Add deltas; returns (call, arguments) for every argument object that just completed
+    def add(self, tool_call_deltas):
+        completed = []
+        for delta in tool_call_deltas:
+            call = self._calls.setdefault(delta.index, {"id": None, "name": None, "arguments": ""})
+            scanner = self._scanners.setdefault(delta.index, JsonObjectScanner())
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function is not None:
+                if delta.function.name:
+                    call["name"] = delta.function.name
+                if delta.function.arguments:
+                    call["arguments"] += delta.function.arguments
+                    for obj in scanner.feed(delta.function.arguments):
+                        completed.append((call, parse_arguments(obj)[0]))
+        return completed
+
+    @property
+    def calls(self):
+        return [self._calls[index] for index in sorted(self._calls) if self._calls[index]["name"]]
+
+    # Function to build the assistant message that announces these tool calls
+    def assistant_message(self, content=None):
+        return assistant_tool_calls_message(self.calls, content)
+
+
+# Function to build an assistant message announcing tool calls given as {"id", "name", "arguments"} dicts
+def assistant_tool_calls_message(calls, content=None):
+    return {
+        "role": "assistant",
+        "content": content or None,
+        "tool_calls": [
+            {
+                "id": call["id"],
+                "type": "function",
+                "function": {"name": call["name"], "arguments": call["arguments"]},
+            }
+            for call in calls
+        ],
+    }
+
+
+# Function to parse tool call arguments into a list of argument objects. Some models still
+# concatenate several objects into one call, so fall back to splitting them.
+def parse_arguments(arguments):
+    try:
+        parsed = json.loads(arguments or "{}")
+        return [parsed] if isinstance(parsed, dict) else [{}]
+    except json.JSONDecodeError:
+        pass
+    parsed_objects = []
+    for obj in re.findall(r'\{.*?\}(?=\{|\Z)', arguments, flags=re.DOTALL):
+        try:
+            parsed_objects.append(json.loads(obj))
+        except json.JSONDecodeError:
+            print(f"Error parsing JSON from function arguments: {obj}. Using empty dict.")
+            parsed_objects.append({})
+    return parsed_objects or [{}]
+
+
+# Function to start a zero-argument tool task on the shared executor
+def start_task(task):
+    return _tool_executor.submit(task)